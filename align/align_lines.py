@@ -1,177 +1,462 @@
-from sys import stderr
+from sys import path, stderr
+import os
 import json
 import argparse
 import numpy as np
-from scipy.spatial.distance import cdist
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 import time
 from pathlib import Path
 
-from Levenshtein import distance
+import Levenshtein
+from rapidfuzz.process import cpdist
+
+try:
+    from align.layout_cache import load_document, page_arrays
+except ModuleNotFoundError:  # run as a script from the align directory
+    from layout_cache import load_document, page_arrays
+    # for the modules at the top of the repository
+    path.append(str(Path(__file__).resolve().parents[1]))
+import instrument
 
 MAXDIST = 30
-IDX_MULT = 10000  # must be set higher than the number of line objects on a page in all pdfs
+LEV_WORKERS = -1  # threads used for batched Levenshtein scoring (-1: all cores)
 HEADER_HEIGHT = 0.1
 FOOTER_HEIGHT = 0.1
 
 
-def list_lines(data, skip_header=True, doc='', verbose=True):
-    if skip_header:
-        page_height = data['cropbox'][3] - data['cropbox'][1]
-        header_bottom = page_height * HEADER_HEIGHT + data['cropbox'][1]
-        footer_top = page_height * (1 - FOOTER_HEIGHT) + data['cropbox'][1]
-        line_list = []
-        top_block_height = page_height
-        bottom_block_height = 0
-        for block in data["blocks"]:
-            if (len(block['lines']) == 1
-                    and block['bbox'][3] < header_bottom
-                    and block['bbox'][3] < top_block_height):
-                top_block_height = block['bbox'][3]
-            elif (len(block['lines']) == 1
-                    and block['bbox'][1] > footer_top
-                    and block['bbox'][1] > bottom_block_height):
-                bottom_block_height = block['bbox'][1]
-        if top_block_height == page_height:
-            top_block_height = 0
-        if bottom_block_height == 0:
-            bottom_block_height = page_height
-
-    for block in data["blocks"]:
-        if (skip_header
-                and len(block['lines']) == 1
-                and block['bbox'][1] < top_block_height):
-            if verbose:
-                print(f"Skipping header {doc}: {block['lines'][0]['text']}")
-            continue
-        elif (skip_header
-              and len(block['lines']) == 1
-              and block['bbox'][3] > bottom_block_height):
-            if verbose:
-                print(f"Skipping footer {doc}: {block['lines'][0]['text']}")
-            continue
+def header_footer_blocks(cropbox, block_bbox, single):
+    '''
+    Masks of the header and the footer blocks of a page. single is the mask
+    of the blocks of a single line. The highest single line block ending in
+    the top HEADER_HEIGHT of the page is the header, with the single line
+    blocks above its bottom, and likewise for the footer.
+    '''
+    page_height = cropbox[3] - cropbox[1]
+    header_bottom = page_height * HEADER_HEIGHT + cropbox[1]
+    footer_top = page_height * (1 - FOOTER_HEIGHT) + cropbox[1]
+    in_header = single & (block_bbox[:, 3] < header_bottom)
+    in_footer = single & ~in_header & (block_bbox[:, 1] > footer_top)
+    top_block_height = block_bbox[in_header, 3].min(initial=page_height)
+    bottom_block_height = block_bbox[in_footer, 1].max(initial=0)
+    if top_block_height == page_height:
+        top_block_height = 0
+    if bottom_block_height == 0:
+        bottom_block_height = page_height
+    header = single & (block_bbox[:, 1] < top_block_height)
+    footer = single & ~header & (block_bbox[:, 3] > bottom_block_height)
+    return header, footer
+
+
+def skipped_blocks(cropbox, block_bbox, block_sizes, skip_header=True):
+    '''
+    Header and footer masks of the blocks of a page, given the number of
+    lines of each block. Nothing is skipped if not skip_header.
+    '''
+    if not skip_header:
+        no_blocks = np.zeros(len(block_sizes), dtype=bool)
+        return no_blocks, no_blocks
+    return header_footer_blocks(cropbox, block_bbox, block_sizes == 1)
+
 
-        for line in block["lines"]:
-            line_list.append(line)
-    return line_list
+def print_skipped(header, footer, texts, doc=''):
+    '''Print the skipped headers and footers, texts[ix] is the text of ix.'''
+    for ix in np.flatnonzero(header | footer):
+        print(f"Skipping {'header' if header[ix] else 'footer'} "
+              f"{doc}: {texts[ix]}")
 
 
-def same_row(line_a, line_b):
-    # base line of line_a is within the vertical span of line_b,
+def list_lines(data, skip_header=True, doc='', verbose=True):
+    '''The line dicts of a page, without its headers and footers.'''
+    blocks = data['blocks']
+    header, footer = skipped_blocks(
+        data['cropbox'],
+        np.array([block['bbox'] for block in blocks],
+                 dtype=float).reshape(-1, 4),
+        np.array([len(block['lines']) for block in blocks], dtype=int),
+        skip_header)
+    if verbose:
+        print_skipped(header, footer,
+                      [block['lines'][0]['text'] if block['lines'] else ''
+                       for block in blocks], doc)
+    skipped = header | footer
+    return [line for block, skip in zip(blocks, skipped.tolist())
+            if not skip for line in block['lines']]
+
+
+class PageLines:
+    '''
+    The lines of a page listed by page_lines, as parallel arrays: bbox
+    (lines, 4), origin and center (lines, 2), block (the number of the
+    block of each line), texts, and no_space, the texts without spaces,
+    which are compared when matching lines.
+    '''
+
+    def __init__(self, texts, bbox, origin, center, block, no_space=None):
+        self.texts = texts
+        self.bbox = bbox
+        self.origin = origin
+        self.center = center
+        self.block = block
+        if no_space is None:
+            no_space = [text.replace(' ', '') for text in texts]
+        self.no_space = no_space
+
+    @classmethod
+    def from_arrays(cls, arrays, skipped):
+        '''
+        The lines of a page given as page_arrays, except those of the
+        skipped blocks.
+        '''
+        block_sizes = np.diff(arrays['block_lines'])
+        line_nums = np.flatnonzero(~np.repeat(skipped, block_sizes))
+        texts = arrays['texts']
+        return cls([texts[ix] for ix in line_nums.tolist()],
+                   arrays['line_bbox'][line_nums],
+                   arrays['line_origin'][line_nums],
+                   arrays['line_center'][line_nums],
+                   np.repeat(arrays['block_number'], block_sizes)[line_nums])
+
+    def __len__(self):
+        return len(self.texts)
+
+    def copy(self):
+        '''
+        A copy whose texts, bbox and center can be rewritten by align_1_2.
+        The texts without spaces are those of the original lines.
+        '''
+        return PageLines(list(self.texts), self.bbox.copy(), self.origin,
+                         self.center.copy(), self.block, self.no_space)
+
+
+def page_lines(pages, p_num, skip_header=True, doc='', verbose=True):
+    '''
+    The lines of page p_num of a loaded document's pages, without headers
+    and footers, as PageLines. The pages of a layout cache are read
+    without building their dicts.
+    '''
+    if hasattr(pages, 'page_arrays'):
+        arrays = pages.page_arrays(p_num)
+    else:
+        arrays = page_arrays(pages[p_num])
+    block_sizes = np.diff(arrays['block_lines'])
+    header, footer = skipped_blocks(arrays['cropbox'], arrays['block_bbox'],
+                                    block_sizes, skip_header)
+    if verbose:
+        # the skipped blocks have a single line
+        print_skipped(np.repeat(header, block_sizes),
+                      np.repeat(footer, block_sizes), arrays['texts'], doc)
+    return PageLines.from_arrays(arrays, header | footer)
+
+
+def same_row(a_lines, a_nums, b_lines, b_nums):
+    '''
+    Whether line a_nums[k] of a_lines and line b_nums[k] of b_lines are on
+    the same row, for all k.
+    '''
+    # base line of line a is within the vertical span of line b,
     # and vice versa
-    # return (line_a['bbox'][1] < line_b['bbox'][3]
-    #         and line_a['bbox'][3] > line_b['bbox'][1])
-    return (line_a['origin'][1] > line_b['bbox'][1]
-            and line_a['origin'][1] < line_b['bbox'][3]
-            and line_b['origin'][1] > line_a['bbox'][1]
-            and line_b['origin'][1] < line_a['bbox'][3])
+    a_base = a_lines.origin[a_nums, 1]
+    b_base = b_lines.origin[b_nums, 1]
+    return ((a_base > b_lines.bbox[b_nums, 1])
+            & (a_base < b_lines.bbox[b_nums, 3])
+            & (b_base > a_lines.bbox[a_nums, 1])
+            & (b_base < a_lines.bbox[a_nums, 3]))
+
+
+def same_row_pairs(lines, line_nums):
+    '''
+    Positions (i, j), i < j, of the lines of line_nums on the same row, in
+    row-major order.
+
+    The lines are sorted by base line, so the lines whose base line is
+    within the vertical span of a line are a window of the sorted order.
+    Only the pairs within the windows are tested.
+    '''
+    line_nums = np.asarray(line_nums, dtype=int)
+    order = np.argsort(lines.origin[line_nums, 1], kind='stable')
+    sorted_base = lines.origin[line_nums[order], 1]
+    starts = np.searchsorted(sorted_base, lines.bbox[line_nums, 1], 'right')
+    ends = np.searchsorted(sorted_base, lines.bbox[line_nums, 3], 'left')
+    sizes = np.maximum(ends - starts, 0)
+    rows = np.repeat(np.arange(len(line_nums)), sizes)
+    window_starts = np.repeat(starts - np.cumsum(sizes) + sizes, sizes)
+    cols = order[window_starts + np.arange(len(rows))]
+    keep = rows < cols
+    rows = rows[keep]
+    cols = cols[keep]
+    keep = same_row(lines, line_nums[rows], lines, line_nums[cols])
+    rows = rows[keep]
+    cols = cols[keep]
+    by_position = np.lexsort((cols, rows))
+    return rows[by_position], cols[by_position]
+
+
+def levenshtein_costs(a_texts, b_texts, rows, cols, score_cutoff=None):
+    '''
+    Levenshtein distances between a_texts[rows[k]] and b_texts[cols[k]]
+    for all k, computed in a single compiled batch.
+
+    Distances above score_cutoff are not computed exactly and are
+    returned as inf.
+    '''
+    if len(rows) == 0:
+        return np.zeros(0)
+    instrument.count('levenshtein_calls', len(rows))
+    dists = cpdist([a_texts[i] for i in rows], [b_texts[j] for j in cols],
+                   scorer=Levenshtein.distance, score_cutoff=score_cutoff,
+                   workers=LEV_WORKERS).astype(float)
+    if score_cutoff is not None:
+        dists[dists > score_cutoff] = np.inf
+    return dists
+
+
+def near_pairs(a_centers, b_centers):
+    '''
+    The line pairs whose centers are closer than MAXDIST, looked up via a
+    KD-tree, as parallel row, column and distance arrays.
+    '''
+    if len(a_centers) == 0 or len(b_centers) == 0:
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int),
+                np.zeros(0))
+    a_centers = np.asarray(a_centers, dtype=float)
+    b_centers = np.asarray(b_centers, dtype=float)
+    near = cKDTree(a_centers).sparse_distance_matrix(
+        cKDTree(b_centers), MAXDIST, output_type='ndarray')
+    rows = near['i'].astype(int)
+    cols = near['j'].astype(int)
+    # recompute the distances the same way as cdist, so that costs (and
+    # therefore tie breaking) do not depend on the tree's arithmetic
+    dists = np.sqrt(((a_centers[rows] - b_centers[cols]) ** 2).sum(axis=1))
+    within = dists < MAXDIST
+    return rows[within], cols[within], dists[within]
+
+
+def score_pairs(rows, cols, dists, a_texts, b_texts, score_cutoff=None):
+    '''
+    Add the Levenshtein distance of the texts to the distances of the
+    pairs, dropping those whose texts are further apart than score_cutoff.
+    '''
+    instrument.count('candidate_pairs', len(rows))
+    costs = dists + levenshtein_costs(a_texts, b_texts, rows, cols,
+                                      score_cutoff)
+    finite = np.isfinite(costs)
+    return rows[finite], cols[finite], costs[finite]
+
+
+def candidate_pairs(a_centers, b_centers, a_texts, b_texts,
+                    score_cutoff=None, pair_filter=None):
+    '''
+    Find the line pairs whose centers are closer than MAXDIST and score them.
+
+    The cost of a pair is the Euclidean distance of the centers plus the
+    Levenshtein distance of the texts. Only pairs within the radius are
+    looked up (via a KD-tree) and scored; they are returned as parallel
+    row, column and cost arrays. Pairs whose Levenshtein distance exceeds
+    score_cutoff are dropped without being scored in full. pair_filter,
+    if given, maps row and column arrays to a mask of the pairs to keep,
+    and is applied before scoring.
+    '''
+    rows, cols, dists = near_pairs(a_centers, b_centers)
+    if pair_filter is not None:
+        keep = pair_filter(rows, cols)
+        rows = rows[keep]
+        cols = cols[keep]
+        dists = dists[keep]
+    return score_pairs(rows, cols, dists, a_texts, b_texts, score_cutoff)
+
+
+def exact_pairs(rows, cols, dists, a_texts, b_texts):
+    '''
+    Mask of the near pairs whose texts are equal, and which any matcher
+    taking pairs in order of cost would pair: every other pair of their
+    lines costs more, whatever its Levenshtein distance.
+
+    The texts are compared by hashing. The Levenshtein distance of two
+    texts is at least the difference of their lengths, and at least 1 if
+    they differ, so the cost of every pair has a lower bound without
+    computing it. A pair of equal texts costs its distance; it is taken
+    if that is below the lower bounds of all the other pairs of its row
+    and of its column.
+    '''
+    text_ids = {}
+    a_ids = np.array([text_ids.setdefault(text, len(text_ids))
+                      for text in a_texts], dtype=int)
+    b_ids = np.array([text_ids.get(text, -1) for text in b_texts],
+                     dtype=int)
+    equal = a_ids[rows] == b_ids[cols]
+    if not equal.any():
+        return equal
+    a_lens = np.array([len(text) for text in a_texts], dtype=int)
+    b_lens = np.array([len(text) for text in b_texts], dtype=int)
+    min_lev = np.where(equal, 0,
+                       np.maximum(np.abs(a_lens[rows] - b_lens[cols]), 1))
+    bounds = dists + min_lev
+    exact = equal
+    for lines, num_lines in [(rows, len(a_texts)), (cols, len(b_texts))]:
+        # the pair is the only one of the smallest bound of its line
+        line_min = np.full(num_lines, np.inf)
+        np.minimum.at(line_min, lines, bounds)
+        at_min = bounds == line_min[lines]
+        exact &= at_min & (np.bincount(lines[at_min],
+                                       minlength=num_lines)[lines] == 1)
+    return exact
+
+
+def greedy_match(rows, cols, costs):
+    '''
+    Pair rows and columns greedily in order of increasing cost.
+
+    Gives the same result as repeatedly taking the argmin of the full cost
+    matrix and deleting its row and column: ties are broken by row index,
+    then by column index. Only finite candidates should be passed.
+    Returns (row, col, cost) triples in the order they were paired.
+    '''
+    used_rows = set()
+    used_cols = set()
+    matches = []
+    for k in np.lexsort((cols, rows, costs)):
+        i = rows[k]
+        j = cols[k]
+        if i in used_rows or j in used_cols:
+            continue
+        used_rows.add(i)
+        used_cols.add(j)
+        matches.append((i, j, costs[k]))
+    return matches
+
+
+def sparse_optimal_match(rows, cols, costs):
+    '''
+    Pair rows and columns with a minimum cost matching of the candidate
+    graph: as many pairs as possible, and of those, the pairs of the least
+    total cost. Each connected component of the graph is solved on its
+    own with linear_sum_assignment. Only finite candidates should be
+    passed. Returns (row, col, cost) triples in order of increasing cost.
+    '''
+    if len(rows) == 0:
+        return []
+    row_ids, row_ix = np.unique(rows, return_inverse=True)
+    col_ids, col_ix = np.unique(cols, return_inverse=True)
+    num_nodes = len(row_ids) + len(col_ids)
+    graph = coo_matrix((np.ones(len(rows)), (row_ix, len(row_ids) + col_ix)),
+                       shape=(num_nodes, num_nodes))
+    _, labels = connected_components(graph, directed=False)
+    components = labels[row_ix]
+    # components of a single candidate are paired as they are
+    single = np.bincount(components)[components] == 1
+    matched = [np.flatnonzero(single)]
+    by_component = np.flatnonzero(~single)
+    by_component = by_component[np.argsort(components[by_component],
+                                           kind='stable')]
+    bounds = np.flatnonzero(np.diff(components[by_component])) + 1
+    for group in np.split(by_component, bounds):
+        if len(group) == 0:
+            continue
+        comp_rows, r = np.unique(row_ix[group], return_inverse=True)
+        comp_cols, c = np.unique(col_ix[group], return_inverse=True)
+        # a missing pair costs more than all the candidates together, so
+        # that as many candidates as possible are paired
+        missing = costs[group].sum() + 1
+        matrix = np.full((len(comp_rows), len(comp_cols)), missing)
+        matrix[r, c] = costs[group]
+        candidate = np.full(matrix.shape, -1)
+        candidate[r, c] = group
+        assigned = candidate[linear_sum_assignment(matrix)]
+        matched.append(assigned[assigned >= 0])
+    matched = np.concatenate(matched)
+    matched = matched[np.lexsort((cols[matched], rows[matched],
+                                  costs[matched]))]
+    return [(rows[k], cols[k], costs[k]) for k in matched]
+
+
+# line matchers of align_pages, greedy is the reference
+MATCHERS = {'greedy': greedy_match,
+            'sparse-optimal': sparse_optimal_match}
 
 
 def align_1_2(unpaired_this, unpaired_other,
-              this_list, other_list,
-              this_no_space, other_no_space,
+              this_lines, other_lines,
               this_name, other_name,
-              verbose=True):
+              verbose=True, score_cutoff=None):
     '''
     Check unpaired lines for possible 1:2 alignments
     '''
 
-    concats = []
     concats_dict = {}
-    concat_texts = []
     new_pairs = []
-    unpaired_this_sorted = sorted(unpaired_this,
-                                    key=lambda x: this_list[x]['bbox'][0])
-    for i in range(len(unpaired_this) - 1):
-        for j in range(i + 1, len(unpaired_this)):
-            if same_row(this_list[unpaired_this_sorted[i]],
-                        this_list[unpaired_this_sorted[j]]):
-                concats.append((unpaired_this_sorted[i],
-                                unpaired_this_sorted[j]))
-                concat_texts.append(this_no_space[i] + this_no_space[j])
-
+    unpaired_this_sorted = np.array(unpaired_this, dtype=int)[np.argsort(
+        this_lines.bbox[unpaired_this, 0], kind='stable')]
+    firsts, seconds = same_row_pairs(this_lines, unpaired_this_sorted)
+    firsts = unpaired_this_sorted[firsts]
+    seconds = unpaired_this_sorted[seconds]
+    concats = list(zip(firsts.tolist(), seconds.tolist()))
+    concat_texts = [this_lines.no_space[i] + this_lines.no_space[j]
+                    for i, j in concats]
+
+    instrument.count('concat_candidates', len(concats))
     if concats and unpaired_other:
         if verbose:
             print("Concats")
             print(concats)
-        # create an array containing the centers of the concatenated lines
-        concat_centers = np.array(
-            [((this_list[conc[0]]['center'][0]
-               + this_list[conc[1]]['center'][0]) / 2,
-              (this_list[conc[0]]['center'][1]
-               + this_list[conc[1]]['center'][1]) / 2)
-                for conc in concats])
-        other_centers = np.array([other_list[line_nr]['center']
-                                  for line_nr in unpaired_other])
-        other_texts = [other_no_space[line_nr]
+        # the centers of the concatenated lines
+        concat_centers = (this_lines.center[firsts]
+                          + this_lines.center[seconds]) / 2
+        other_nums = np.array(unpaired_other, dtype=int)
+        other_texts = [other_lines.no_space[line_nr]
                        for line_nr in unpaired_other]
 
-        unp_distance_matrix = cdist(concat_centers, other_centers)
-        unp_idx_matrix = np.zeros([len(concat_centers), len(other_centers)],
-                                    dtype=int)
-        for i in range(len(concat_centers)):
-            for j in range(len(other_centers)):
-                unp_idx_matrix[i, j] = IDX_MULT * i + j
-
-        for i, a in enumerate(concat_texts):
-            for j, b in enumerate(other_texts):
-                if unp_distance_matrix[i, j] < MAXDIST:
-                    unp_distance_matrix[i, j] += distance(a, b)
-                else:
-                    unp_distance_matrix[i, j] = np.inf
-
-        # TODO: Ezt ki kell javítani, hibás az algoritmus. Nemcsak a this dokumentumon
-        # belül igaz, hogy közös soron van a két összekapcsolandó elem, hanem az
-        # other dokumentumbeli párjuk is közös soron van ezekkel. Így nincs értelme
-        # teljes távolságmátrixszal dolgozni, és könnyen lehet, hogy vertikálisan
-        # rossz helyen levő sort illesztünk, így a helyes pár már nem elérhető, mire sorra
-        # kerül.
-
-        while unp_distance_matrix.shape[0] > 0 and unp_distance_matrix.shape[1] > 0:
-            min_i, min_j = np.unravel_index(np.argmin(unp_distance_matrix),
-                                            unp_distance_matrix.shape)
-            if unp_distance_matrix[min_i, min_j] == np.inf:
-                break
-            else:
-                concat_idx = unp_idx_matrix[min_i, min_j] // IDX_MULT
-                unpaired_other_idx = unp_idx_matrix[min_i, min_j] % IDX_MULT
-                concat_1 = this_list[concats[concat_idx][0]]
-                concat_2 = this_list[concats[concat_idx][1]]
-                if verbose:
-                    print(f'{this_name}1', concats[concat_idx][0], concat_1['text'])
-                    print(f'{this_name}2', concats[concat_idx][1], concat_2['text'])
-                    print(other_name, unpaired_other[unpaired_other_idx],
-                        other_list[unpaired_other[unpaired_other_idx]]['text'])
-
-                # Change text and coordinates of the left half of the
-                # concatenated line and remove text from the right half
-                concat_1['bbox'] = [
-                    concat_1['bbox'][0],
-                    min(concat_1['bbox'][1], concat_2['bbox'][1]),
-                    concat_2['bbox'][2],
-                    max(concat_1['bbox'][3], concat_2['bbox'][3])]
-                concat_1['text'] += concat_2['text']
-                concat_1['center'] = [
-                    (concat_1['bbox'][0] + concat_1['bbox'][2]) / 2,
-                    (concat_1['bbox'][1] + concat_1['bbox'][3]) / 2]
-                
-                concat_2['text'] = ' '
-
-                new_pairs.append((concats[concat_idx][0],
-                                  unpaired_other[unpaired_other_idx]))
-                concats_dict[concats[concat_idx][0]] = concats[concat_idx][1]
-                unp_distance_matrix = np.delete(
-                    np.delete(unp_distance_matrix, min_i, axis=0), min_j, axis=1)
-                unp_idx_matrix = np.delete(
-                    np.delete(unp_idx_matrix, min_i, axis=0), min_j, axis=1)
+        def on_concat_row(rows, cols):
+            # the pair of the concatenated lines in the other version is
+            # on the same row as both of them
+            return (same_row(this_lines, firsts[rows],
+                             other_lines, other_nums[cols])
+                    & same_row(this_lines, seconds[rows],
+                               other_lines, other_nums[cols]))
+
+        rows, cols, costs = candidate_pairs(
+            concat_centers, other_lines.center[other_nums], concat_texts,
+            other_texts, score_cutoff, pair_filter=on_concat_row)
+
+        texts = this_lines.texts
+        bbox = this_lines.bbox
+        for concat_idx, unpaired_other_idx, _ in greedy_match(
+                rows, cols, costs):
+            concat_1, concat_2 = concats[concat_idx]
+            if verbose:
+                print(f'{this_name}1', concat_1, texts[concat_1])
+                print(f'{this_name}2', concat_2, texts[concat_2])
+                print(other_name, unpaired_other[unpaired_other_idx],
+                    other_lines.texts[unpaired_other[unpaired_other_idx]])
+
+            # Change text and coordinates of the left half of the
+            # concatenated line and remove text from the right half
+            bbox[concat_1] = [
+                bbox[concat_1, 0],
+                min(bbox[concat_1, 1], bbox[concat_2, 1]),
+                bbox[concat_2, 2],
+                max(bbox[concat_1, 3], bbox[concat_2, 3])]
+            texts[concat_1] += texts[concat_2]
+            this_lines.center[concat_1] = [
+                (bbox[concat_1, 0] + bbox[concat_1, 2]) / 2,
+                (bbox[concat_1, 1] + bbox[concat_1, 3]) / 2]
+
+            texts[concat_2] = ' '
+
+            new_pairs.append((concat_1,
+                              unpaired_other[unpaired_other_idx]))
+            concats_dict[concat_1] = concat_2
 
     return new_pairs, concats_dict
 
 
-def find_unpaired(a_list, b_list, pairs_dict):
+def find_unpaired(a_lines, b_lines, pairs_dict):
     paired_bs = set(pairs_dict.values())
-    unpaired_a = [i for i in range(len(a_list))
+    unpaired_a = [i for i in range(len(a_lines))
                   if i not in pairs_dict]
-    unpaired_b = [i for i in range(len(b_list))
+    unpaired_b = [i for i in range(len(b_lines))
                   if i not in paired_bs]
     return unpaired_a, unpaired_b
 
@@ -185,160 +470,220 @@ def argparser():
     parser.add_argument('--verbose', '-v', type=int, default=0,
                         help='Verbosity levels: full (2), diff (1), false (0)')
     parser.add_argument('--output_dir', '-o', type=str, default='.')
+    parser.add_argument('--max_lev', type=int, default=None,
+                        help='Do not pair lines whose texts are further '
+                             'apart than this Levenshtein distance '
+                             '(default: no limit, exact greedy result)')
+    parser.add_argument('--matcher', choices=MATCHERS, default='greedy',
+                        help='Pair nearby lines greedily by cost, or by a '
+                             'minimum cost matching of each connected '
+                             'group of candidates')
+    instrument.add_arguments(parser)
     return parser.parse_args()
 
 
-def main():
-    args = argparser()
-    start_t = time.time()
-    with (open(args.a_file) as a_file,
-        open(args.b_file) as b_file):
-        doc_a = json.load(a_file)
-        doc_b = json.load(b_file)
-
-    if args.verbose:
-        print(f'{args.a_label} file: {args.a_file}')
-        print(f'{args.b_label} file: {args.b_file}')
-        print()
+def align_pages(a_lines, b_lines, a_label='A', b_label='B', verbose=0,
+                max_lev=None, matcher='greedy'):
+    '''
+    Align the lines of one page of two versions, as returned by page_lines.
+    Returns the pairs dict of the page in the format of the output file.
+    The PageLines passed in are not modified. matcher is one of MATCHERS,
+    it pairs the lines before the 1:2 alignments.
+    '''
+    # align_1_2 rewrites the text and bbox of concatenated lines
+    a_lines = a_lines.copy()
+    b_lines = b_lines.copy()
+
+    instrument.count('a_lines', len(a_lines))
+    instrument.count('b_lines', len(b_lines))
+
+    # Levenshtein distance between line texts, ignoring spaces, is
+    # added to the distance of the centers of nearby lines
+    with instrument.timed('candidate_pairs'):
+        rows, cols, dists = near_pairs(a_lines.center, b_lines.center)
+        # lines of identical texts are paired without scoring, the rest
+        # is scored and matched without them. This only gives the same
+        # result for greedy: an optimal matching may pair more lines by
+        # leaving out an identical pair.
+        if matcher == 'greedy':
+            exact = exact_pairs(rows, cols, dists, a_lines.no_space,
+                                b_lines.no_space)
+        else:
+            exact = np.zeros(len(rows), dtype=bool)
+        instrument.count('exact_pairs', int(exact.sum()))
+        a_paired = np.zeros(len(a_lines), dtype=bool)
+        a_paired[rows[exact]] = True
+        b_paired = np.zeros(len(b_lines), dtype=bool)
+        b_paired[cols[exact]] = True
+        residue = ~(a_paired[rows] | b_paired[cols])
+        res_rows, res_cols, res_costs = score_pairs(
+            rows[residue], cols[residue], dists[residue], a_lines.no_space,
+            b_lines.no_space, max_lev)
+    pairs_dict = {}
+    with instrument.timed('match'):
+        matches = MATCHERS[matcher](res_rows, res_cols, res_costs)
+    matches.extend(zip(rows[exact], cols[exact], dists[exact]))
+    # in the order greedy_match would have paired them
+    matches.sort(key=lambda match: (match[2], match[0], match[1]))
+    for line_a, line_b, cost in matches:
+        pairs_dict[int(line_a)] = int(line_b)
+        if verbose == 2:
+            print(line_a, line_b, cost)
+
+    unpaired_a, unpaired_b = find_unpaired(a_lines, b_lines, pairs_dict)
+
+    with instrument.timed('align_1_2'):
+        new_pairs, a_concats = align_1_2(
+            unpaired_a, unpaired_b, a_lines, b_lines,
+            a_label, b_label, verbose, max_lev)
 
-    outdict = {'a_file': args.a_file,
-               'b_file': args.b_file,
-               'a_label': args.a_label,
-               'b_label': args.b_label,
-               'pages': []}
+    for a, b in new_pairs:
+        pairs_dict[a] = b
 
-    for p_num in range(min(len(doc_a['pages']), len(doc_b['pages']))):
-        if args.verbose:
-            print("Page", p_num)
-        a_list = list_lines(doc_a['pages'][p_num], doc=args.a_label,
-                            verbose=args.verbose)
-        b_list = list_lines(doc_b['pages'][p_num], doc=args.b_label,
-                            verbose=args.verbose)
+    unpaired_a, unpaired_b = find_unpaired(a_lines, b_lines, pairs_dict)
 
-        a_no_space = [a['text'].replace(' ', '')
-                      for a in a_list]
-        b_no_space = [b['text'].replace(' ', '')
-                      for b in b_list]
+    with instrument.timed('align_1_2'):
+        new_pairs, b_concats = align_1_2(
+            unpaired_b, unpaired_a, b_lines, a_lines,
+            b_label, a_label, verbose, max_lev)
+    for b, a in new_pairs:
+        pairs_dict[a] = b
 
-        a_centers = np.array([line['center'] for line in a_list])
-        b_centers = np.array([line['center'] for line in b_list])
+    pairs_list = []
+    for a, b in pairs_dict.items():
+        pairs_list.append((a, b))
 
-        # Calculate the Euclidean distance matrix
-        try:
-            distance_matrix = cdist(a_centers, b_centers)
-        except ValueError:
-            distance_matrix = np.zeros([0, 0])
-        idx_matrix = np.zeros([len(a_centers), len(b_centers)], dtype=int)
-        for i in range(len(a_centers)):
-            for j in range(len(b_centers)):
-                idx_matrix[i, j] = IDX_MULT * i + j
-        pairs_dict = {}
-
-        for i, a in enumerate(a_no_space):
-            for j, b in enumerate(b_no_space):
-                if distance_matrix[i, j] < MAXDIST:
-                    # Levenshtein distance between line texts, ignoring spaces
-                    distance_matrix[i, j] += distance(a, b)
-                else:
-                    distance_matrix[i, j] = np.inf
-
-        while distance_matrix.shape[0] > 0 and distance_matrix.shape[1] > 0:
-            min_i, min_j = np.unravel_index(np.argmin(distance_matrix),
-                                            distance_matrix.shape)
-            if distance_matrix[min_i, min_j] == np.inf:
-                break
-            else:
-                line_a = idx_matrix[min_i, min_j] // IDX_MULT
-                line_b = idx_matrix[min_i, min_j] % IDX_MULT
-                pairs_dict[int(line_a)] = int(line_b)
-                if args.verbose == 2:
-                    print(line_a, line_b, distance_matrix[min_i, min_j])
-                distance_matrix = np.delete(
-                    np.delete(distance_matrix, min_i, axis=0), min_j, axis=1)
-                idx_matrix = np.delete(
-                    np.delete(idx_matrix, min_i, axis=0), min_j, axis=1)
-
-        unpaired_a, unpaired_b = find_unpaired(a_list, b_list, pairs_dict)
+    unpaired_a, unpaired_b = find_unpaired(a_lines, b_lines, pairs_dict)
+    instrument.count('pairs', len(pairs_list))
+    instrument.count('unpaired_a', len(unpaired_a))
+    instrument.count('unpaired_b', len(unpaired_b))
 
-        new_pairs, a_concats = align_1_2(
-            unpaired_a, unpaired_b, a_list, b_list, a_no_space, b_no_space,
-            args.a_label, args.b_label, args.verbose)
+    pairs_dict[None] = []
 
-        for a, b in new_pairs:
-            pairs_dict[a] = b
+    for a in unpaired_a:
+        pairs_dict[a] = None
+        pairs_list.append((a, None))
+    for b in unpaired_b:
+        pairs_dict[None].append(b)
+        pairs_list.append((None, b))
 
-        unpaired_a, unpaired_b = find_unpaired(a_list, b_list, pairs_dict)
+    pairs_list = sorted(pairs_list, key=lambda x: (x[0] or 0) or (x[1] or 0))
 
-        new_pairs, b_concats = align_1_2(
-            unpaired_b, unpaired_a, b_list, a_list, b_no_space, a_no_space,
-            args.b_label, args.a_label, args.verbose)
-        for b, a in new_pairs:
-            pairs_dict[a] = b
+    if verbose:
+        print()
+
+    for line_a, line_b in pairs_list:
+        try:
+            a_text = a_lines.texts[line_a].rstrip().replace("\u00AD", "-")
+        except:
+            a_text = None
+        try:
+            b_text = b_lines.texts[line_b].rstrip().replace("\u00AD", "-")
+        except:
+            b_text = None
+        if verbose and line_a is not None and line_b is not None:
+            if line_a in a_concats:
+                line_a = (line_a, a_concats[line_a])
+            if line_b in b_concats:
+                line_b = (line_b, b_concats[line_b])
+            if a_text != b_text:
+                print(line_a, a_text)
+                print("!!!")
+                print(line_b, b_text)
+                print()
+            elif verbose == 2:
+                print(line_a, a_text)
+                print("=")
+                print(line_b)
+                print()
+
+    del_keys = []
+    new_pairs = {}
+    for k, v in pairs_dict.items():
+#        print(k, type(k), v, type(v))
+        if k in a_concats:
+            new_pairs[f'{k}+{a_concats[k]}'] = v
+            del_keys.append(k)
+        if type(v) == int and v in b_concats:
+            pairs_dict[k] = f'{v}+{b_concats[v]}'
+    for k in del_keys:
+        del pairs_dict[k]
+    pairs_dict.update(new_pairs)
+
+    return pairs_dict
+
+
+def align_documents(doc_a, doc_b, a_label='A', b_label='B', verbose=0,
+                    max_lev=None, matcher='greedy'):
+    '''Align two loaded documents page by page.'''
+    pages = []
+    for p_num in range(min(len(doc_a['pages']), len(doc_b['pages']))):
+        if verbose:
+            print("Page", p_num)
+        with instrument.page(p_num):
+            with instrument.timed('page_lines'):
+                a_lines = page_lines(doc_a['pages'], p_num, doc=a_label,
+                                     verbose=verbose)
+                b_lines = page_lines(doc_b['pages'], p_num, doc=b_label,
+                                     verbose=verbose)
+            pages.append(align_pages(a_lines, b_lines, a_label, b_label,
+                                     verbose, max_lev, matcher))
+    return pages
 
-        pairs_list = []
-        for a, b in pairs_dict.items():
-            pairs_list.append((a, b))
 
-        unpaired_a, unpaired_b = find_unpaired(a_list, b_list, pairs_dict)
+def alignment_fname(a_file, a_label, b_label, output_dir='.'):
+    return (output_dir + '/' + Path(a_file).stem
+            + f'_{a_label}_{b_label}.json')
 
-        pairs_dict[None] = []
 
-        for a in unpaired_a:
-            pairs_dict[a] = None
-            pairs_list.append((a, None))
-        for b in unpaired_b:
-            pairs_dict[None].append(b)
-            pairs_list.append((None, b))
+def write_json(obj, fname):
+    '''
+    Write obj to fname through a temporary file, so that an interrupted
+    run never leaves a truncated output behind.
+    '''
+    tmp_fname = fname + '.part'
+    with open(tmp_fname, 'w', encoding='utf-8') as outfile:
+        json.dump(obj, outfile)
+    os.replace(tmp_fname, fname)
+
 
-        pairs_list = sorted(pairs_list, key=lambda x: (x[0] or 0) or (x[1] or 0))
+def align_files(a_file, b_file, a_label='A', b_label='B', verbose=0,
+                output_dir='.', max_lev=None, matcher='greedy'):
+    '''
+    Align two versions of a document and write the alignment to
+    output_dir. Either file can be JSON or a layout cache directory.
+    Returns the name of the alignment file.
+    '''
+    with instrument.stage('align_files', a_file=a_file, b_file=b_file):
+        with instrument.timed('load'):
+            doc_a = load_document(a_file)
+            doc_b = load_document(b_file)
 
-        if args.verbose:
+        if verbose:
+            print(f'{a_label} file: {a_file}')
+            print(f'{b_label} file: {b_file}')
             print()
 
-        for line_a, line_b in pairs_list:
-            try:
-                a_text = a_list[line_a]['text'].rstrip().replace("\u00AD", "-")
-            except:
-                a_text = None
-            try:
-                b_text = b_list[line_b]['text'].rstrip().replace("\u00AD", "-")
-            except:
-                b_text = None
-            if args.verbose and line_a is not None and line_b is not None:
-                if line_a in a_concats:
-                    line_a = (line_a, a_concats[line_a])
-                if line_b in b_concats:
-                    line_b = (line_b, b_concats[line_b])
-                if a_text != b_text:
-                    print(line_a, a_text)
-                    print("!!!")
-                    print(line_b, b_text)
-                    print()
-                elif args.verbose == 2:
-                    print(line_a, a_text)
-                    print("=")
-                    print(line_b)
-                    print()
-
-        del_keys = []
-        new_pairs = {}
-        for k, v in pairs_dict.items():
-#            print(k, type(k), v, type(v))
-            if k in a_concats:
-                new_pairs[f'{k}+{a_concats[k]}'] = v
-                del_keys.append(k)
-            if type(v) == int and v in b_concats:
-                pairs_dict[k] = f'{v}+{b_concats[v]}'
-        for k in del_keys:
-            del pairs_dict[k]
-        pairs_dict.update(new_pairs)
-
-        outdict['pages'].append(pairs_dict)
-
-    json_file = (args.output_dir + '/' + Path(args.a_file).stem
-                 + f'_{args.a_label}_{args.b_label}.json')
-    with open(json_file, 'w', encoding='utf-8') as outfile:
-        json.dump(outdict, outfile)
+        outdict = {'a_file': a_file,
+                   'b_file': b_file,
+                   'a_label': a_label,
+                   'b_label': b_label,
+                   'pages': align_documents(doc_a, doc_b, a_label, b_label,
+                                            verbose, max_lev, matcher)}
+
+        json_file = alignment_fname(a_file, a_label, b_label, output_dir)
+        with instrument.timed('write'):
+            write_json(outdict, json_file)
+    return json_file
+
+
+def main():
+    args = argparser()
+    instrument.setup(args, 'align_lines')
+    start_t = time.time()
+    json_file = align_files(args.a_file, args.b_file,
+                            args.a_label, args.b_label, args.verbose,
+                            args.output_dir, args.max_lev, args.matcher)
     print(json_file, file=stderr)
     print("Time", time.time() - start_t, file=stderr)
 
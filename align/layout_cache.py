@@ -0,0 +1,226 @@
+'''
+Columnar on-disk cache of page layouts.
+
+The JSON documents written by pdf_extract (pages -> blocks -> lines with
+bbox, origin, center and text) are slow to parse, and the whole issue has
+to be parsed to get at a single page. This module stores the same data as
+a directory of .npy arrays that are memory-mapped on load:
+
+    page_cropbox   (pages, 4)     cropbox of each page
+    page_blocks    (pages + 1,)   offsets of each page's blocks
+    block_number   (blocks,)      block number
+    block_bbox     (blocks, 4)
+    block_lines    (blocks + 1,)  offsets of each block's lines
+    line_bbox      (lines, 4)
+    line_origin    (lines, 2)
+    line_center    (lines, 2)
+    text_offsets   (lines + 1,)   byte offsets of each line's text
+    text           (bytes,)       UTF-8 text of all lines
+
+Loading a page only touches the slices of the page, and rebuilds the page
+dict that list_lines expects, or just its arrays for page_lines.
+
+    python align/layout_cache.py doc.json [doc2.json ...]
+'''
+import json
+from pathlib import Path
+from sys import argv, intern
+
+import numpy as np
+
+LAYOUT_SUFFIX = '.layout'
+# float64 keeps the coordinates of the JSON exactly, so alignments do not
+# depend on which format they were computed from
+COORD_DTYPE = np.float64
+ARRAYS = ['page_cropbox', 'page_blocks', 'block_number', 'block_bbox',
+          'block_lines', 'line_bbox', 'line_origin', 'line_center',
+          'text_offsets', 'text']
+
+
+def layout_fname(json_fname):
+    return str(Path(json_fname).with_suffix(LAYOUT_SUFFIX))
+
+
+def is_layout(fname):
+    return Path(fname).suffix == LAYOUT_SUFFIX and Path(fname).is_dir()
+
+
+def convert(doc, layout_dir):
+    '''Write a loaded JSON document in the columnar format.'''
+    page_cropbox = []
+    page_blocks = [0]
+    block_number = []
+    block_bbox = []
+    block_lines = [0]
+    line_bbox = []
+    line_origin = []
+    line_center = []
+    text_offsets = [0]
+    texts = []
+    for page in doc['pages']:
+        page_cropbox.append(page['cropbox'])
+        for block in page['blocks']:
+            block_number.append(block['number'])
+            block_bbox.append(block['bbox'])
+            for line in block['lines']:
+                line_bbox.append(line['bbox'])
+                line_origin.append(line['origin'])
+                line_center.append(line['center'])
+                text = line['text'].encode('utf-8')
+                texts.append(text)
+                text_offsets.append(text_offsets[-1] + len(text))
+            block_lines.append(len(line_bbox))
+        page_blocks.append(len(block_bbox))
+
+    arrays = {
+        'page_cropbox': np.array(page_cropbox, dtype=COORD_DTYPE)
+                          .reshape(-1, 4),
+        'page_blocks': np.array(page_blocks, dtype=np.int64),
+        'block_number': np.array(block_number, dtype=np.int64),
+        'block_bbox': np.array(block_bbox, dtype=COORD_DTYPE).reshape(-1, 4),
+        'block_lines': np.array(block_lines, dtype=np.int64),
+        'line_bbox': np.array(line_bbox, dtype=COORD_DTYPE).reshape(-1, 4),
+        'line_origin': np.array(line_origin, dtype=COORD_DTYPE)
+                         .reshape(-1, 2),
+        'line_center': np.array(line_center, dtype=COORD_DTYPE)
+                         .reshape(-1, 2),
+        'text_offsets': np.array(text_offsets, dtype=np.int64),
+        'text': np.frombuffer(b''.join(texts), dtype=np.uint8)}
+
+    Path(layout_dir).mkdir(parents=True, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(Path(layout_dir) / f'{name}.npy', array)
+
+
+def page_arrays(page):
+    '''
+    The arrays of a page dict, in the format of LayoutPages.page_arrays.
+    '''
+    block_number = []
+    block_bbox = []
+    block_lines = [0]
+    # coordinates are collected flat, which is faster to convert
+    line_bbox = []
+    line_origin = []
+    line_center = []
+    texts = []
+    for block in page['blocks']:
+        block_number.append(block['number'])
+        block_bbox.extend(block['bbox'])
+        for line in block['lines']:
+            line_bbox.extend(line['bbox'])
+            line_origin.extend(line['origin'])
+            line_center.extend(line['center'])
+            texts.append(intern(line['text']))
+        block_lines.append(len(texts))
+    return {
+        'cropbox': np.array(page['cropbox'], dtype=COORD_DTYPE),
+        'block_number': np.array(block_number, dtype=np.int64),
+        'block_bbox': np.array(block_bbox, dtype=COORD_DTYPE).reshape(-1, 4),
+        'block_lines': np.array(block_lines, dtype=np.int64),
+        'line_bbox': np.array(line_bbox, dtype=COORD_DTYPE).reshape(-1, 4),
+        'line_origin': np.array(line_origin, dtype=COORD_DTYPE)
+                         .reshape(-1, 2),
+        'line_center': np.array(line_center, dtype=COORD_DTYPE)
+                         .reshape(-1, 2),
+        'texts': texts}
+
+
+class LayoutPages:
+    '''Sequence of page dicts, each built from the arrays on access.'''
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays['page_cropbox'])
+
+    def __getitem__(self, p_num):
+        if isinstance(p_num, slice):
+            return [self[ix] for ix in range(*p_num.indices(len(self)))]
+        if not -len(self) <= p_num < len(self):
+            raise IndexError(p_num)
+        p_num %= len(self)
+        a = self.arrays
+        page = {'cropbox': a['page_cropbox'][p_num].tolist(), 'blocks': []}
+        for b_num in range(a['page_blocks'][p_num],
+                           a['page_blocks'][p_num + 1]):
+            first, last = a['block_lines'][b_num], a['block_lines'][b_num + 1]
+            offsets = a['text_offsets'][first:last + 1].tolist()
+            text = a['text'][offsets[0]:offsets[-1]].tobytes()
+            bboxes = a['line_bbox'][first:last].tolist()
+            origins = a['line_origin'][first:last].tolist()
+            centers = a['line_center'][first:last].tolist()
+            lines = []
+            for ix in range(last - first):
+                lines.append(
+                    {'origin': origins[ix],
+                     'bbox': bboxes[ix],
+                     'text': text[offsets[ix] - offsets[0]:
+                                  offsets[ix + 1] - offsets[0]]
+                             .decode('utf-8'),
+                     'center': centers[ix]})
+            page['blocks'].append({'number': int(a['block_number'][b_num]),
+                                   'lines': lines,
+                                   'bbox': a['block_bbox'][b_num].tolist()})
+        return page
+
+    def __iter__(self):
+        for p_num in range(len(self)):
+            yield self[p_num]
+
+    def page_arrays(self, p_num):
+        '''
+        The arrays of a page without building its dicts: cropbox, the
+        number and bbox of its blocks, block_lines offsets of the lines of
+        each block, the bbox, origin and center of its lines, and texts,
+        the (interned) texts of its lines.
+        '''
+        a = self.arrays
+        first_block, last_block = a['page_blocks'][p_num:p_num + 2]
+        block_lines = np.array(a['block_lines'][first_block:last_block + 1])
+        first, last = block_lines[0], block_lines[-1]
+        offsets = a['text_offsets'][first:last + 1].tolist()
+        text = a['text'][offsets[0]:offsets[-1]].tobytes()
+        return {
+            'cropbox': np.array(a['page_cropbox'][p_num]),
+            'block_number': np.array(a['block_number'][first_block:
+                                                       last_block]),
+            'block_bbox': np.array(a['block_bbox'][first_block:last_block]),
+            'block_lines': block_lines - first,
+            'line_bbox': np.array(a['line_bbox'][first:last]),
+            'line_origin': np.array(a['line_origin'][first:last]),
+            'line_center': np.array(a['line_center'][first:last]),
+            'texts': [intern(text[start - offsets[0]:end - offsets[0]]
+                             .decode('utf-8'))
+                      for start, end in zip(offsets, offsets[1:])]}
+
+
+def load_layout(layout_dir):
+    '''
+    Open a columnar layout cache. The result can be used like a loaded
+    JSON document: doc['pages'][p_num] is the page dict.
+    '''
+    arrays = {name: np.load(Path(layout_dir) / f'{name}.npy', mmap_mode='r')
+              for name in ARRAYS}
+    return {'pages': LayoutPages(arrays)}
+
+
+def load_document(fname):
+    '''Load a page layout document from either JSON or the layout cache.'''
+    if is_layout(fname):
+        return load_layout(fname)
+    with open(fname) as json_file:
+        return json.load(json_file)
+
+
+def main():
+    for json_fname in argv[1:]:
+        with open(json_fname) as json_file:
+            doc = json.load(json_file)
+        convert(doc, layout_fname(json_fname))
+        print(layout_fname(json_fname))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,262 @@
+'''
+Align every issue of the corpus across consecutive OCR versions.
+
+    python align_ocrs.py elkeszult_fr14 elkeszult_fr15 elkeszult_fr16 \
+        -g '**/*168ora*.json' -o alignments -j 8
+
+Issues are globbed in the first version directory and looked up under the
+same relative path in the others. Each (issue, version pair) is a separate
+job. Jobs whose alignment file already exists are skipped, so an
+interrupted run can simply be restarted. Every finished job is appended
+to a JSON Lines manifest with its status and timing. Alignment files are
+named after the issue file only, so the run is refused if two issues in
+different subdirectories share a name.
+
+With --chain, each issue is a single job that loads every version once and
+writes the alignments and the diff sets of all adjacent version pairs.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
+
 import align.align_lines
-from sys import argv
-
-base_path = Path('\\arcanum_2023_OCR\\elkeszult_fr14')
-files = base_path.glob('**/*.json')
-
-argv.extend(['file1', 'file2', '-a', 'FR1', '-b', 'FR2',
-             '-v', '0', '-o', 'alignments'])
-
-for file in files:
-    file14 = str(file)
-    if '168ora' not in file14:
-        continue
-    file15 = file14.replace('_fr14', '_fr15')
-    file16 = file15.replace('_fr15', '_fr16')
-
-    argv[1] = file14
-    argv[2] = file15
-    argv[4] = 'FR14'
-    argv[6] = 'FR15'
-    align.align_lines.main()
-
-    argv[1] = file15
-    argv[2] = file16
-    argv[4] = 'FR15'
-    argv[6] = 'FR16'
-    align.align_lines.main()
+import instrument
+from align.align_lines import (MATCHERS, align_files, align_pages,
+                               alignment_fname, page_lines, write_json)
+from align.layout_cache import load_document
+from diff_lines import DIFF_BACKENDS, diff_documents, diffs_fname
+
+
+def version_label(version_dir):
+    '''elkeszult_fr14 -> FR14'''
+    return Path(version_dir).name.split('_')[-1].upper()
+
+
+def align_chain(files, labels, output_dir='.', max_lev=None,
+                diff_backend='difflib', matcher='greedy'):
+    '''
+    Align consecutive versions of a document and generate their diff sets.
+
+    Each version is parsed and its pages are listed only once, and is
+    reused for the pairs on both sides of it. Only two versions are held
+    in memory at a time. Returns the names of the files written.
+    '''
+    written = []
+    prev_file = prev_label = prev_pages = None
+    for file, label in zip(files, labels):
+        doc = load_document(file)
+        pages = [page_lines(doc['pages'], p_num, doc=label, verbose=False)
+                 for p_num in range(len(doc['pages']))]
+        del doc
+
+        if prev_pages is not None:
+            num_pages = min(len(prev_pages), len(pages))
+            with instrument.stage('align_chain', a_file=prev_file,
+                                  b_file=file):
+                aligned_pages = []
+                for p_num in range(num_pages):
+                    with instrument.page(p_num):
+                        aligned_pages.append(
+                            align_pages(prev_pages[p_num], pages[p_num],
+                                        prev_label, label, max_lev=max_lev,
+                                        matcher=matcher))
+                alignment = {
+                    'a_file': prev_file,
+                    'b_file': file,
+                    'a_label': prev_label,
+                    'b_label': label,
+                    'pages': aligned_pages}
+                json_file = alignment_fname(prev_file, prev_label, label,
+                                            output_dir)
+                diff_dict = {
+                    'alignment_file': json_file,
+                    'a_label': prev_label,
+                    'b_label': label,
+                    'alt_sets': diff_documents(alignment, prev_pages, pages,
+                                               diff_backend)}
+            # the diffs are written first: the alignment file marks the
+            # pair as done
+            write_json(diff_dict, diffs_fname(json_file))
+            write_json(alignment, json_file)
+            written.extend([json_file, diffs_fname(json_file)])
+
+        prev_file, prev_label, prev_pages = file, label, pages
+    return written
+
+
+def list_chain_jobs(version_dirs, labels, pattern, output_dir):
+    base_path = Path(version_dirs[0])
+    for file in sorted(base_path.glob(pattern)):
+        rel_path = file.relative_to(base_path)
+        files = [str(Path(version_dir) / rel_path)
+                 for version_dir in version_dirs]
+        yield {'files': files, 'labels': labels,
+               'output': alignment_fname(files[-2], labels[-2], labels[-1],
+                                         output_dir)}
+
+
+def list_jobs(version_dirs, labels, pattern, output_dir):
+    base_path = Path(version_dirs[0])
+    for file in sorted(base_path.glob(pattern)):
+        rel_path = file.relative_to(base_path)
+        for (a_dir, a_label), (b_dir, b_label) in zip(
+                zip(version_dirs, labels),
+                zip(version_dirs[1:], labels[1:])):
+            a_file = str(Path(a_dir) / rel_path)
+            b_file = str(Path(b_dir) / rel_path)
+            yield {'a_file': a_file, 'b_file': b_file,
+                   'a_label': a_label, 'b_label': b_label,
+                   'output': alignment_fname(a_file, a_label, b_label,
+                                             output_dir)}
+
+
+def check_outputs(jobs):
+    '''
+    Outputs are named by the file stem only, so issues with the same name
+    in different subdirectories would overwrite each other's alignments.
+    Raises ValueError listing such clashes.
+    '''
+    first_of = {}
+    clashes = []
+    for job in jobs:
+        source = job.get('a_file') or job['files'][0]
+        if job['output'] in first_of:
+            clashes.append(f"{first_of[job['output']]} and {source} -> "
+                           f"{job['output']}")
+        else:
+            first_of[job['output']] = source
+    if clashes:
+        raise ValueError('outputs written by more than one issue:\n'
+                         + '\n'.join(clashes))
+
+
+def init_worker():
+    # parallelism comes from the process pool
+    align.align_lines.LEV_WORKERS = 1
+
+
+def run_job(job, output_dir, max_lev, matcher='greedy'):
+    start_t = time.time()
+    result = dict(job)
+    try:
+        if not Path(job['b_file']).exists():
+            raise FileNotFoundError(job['b_file'])
+        align_files(job['a_file'], job['b_file'],
+                    job['a_label'], job['b_label'],
+                    verbose=0, output_dir=output_dir, max_lev=max_lev,
+                    matcher=matcher)
+        result['status'] = 'ok'
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+        result['traceback'] = traceback.format_exc()
+    result['seconds'] = round(time.time() - start_t, 3)
+    return result
+
+
+def run_chain_job(job, output_dir, max_lev, diff_backend='difflib',
+                  matcher='greedy'):
+    start_t = time.time()
+    result = dict(job)
+    try:
+        for file in job['files']:
+            if not Path(file).exists():
+                raise FileNotFoundError(file)
+        align_chain(job['files'], job['labels'], output_dir, max_lev,
+                    diff_backend, matcher)
+        result['status'] = 'ok'
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+        result['traceback'] = traceback.format_exc()
+    result['seconds'] = round(time.time() - start_t, 3)
+    return result
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('version_dirs', nargs='+',
+                        help='Directories of consecutive OCR versions')
+    parser.add_argument('--labels', '-l', nargs='+', default=None,
+                        help='Version labels (default: FR14 for '
+                             'elkeszult_fr14 etc.)')
+    parser.add_argument('--glob', '-g', type=str, default='**/*.json')
+    parser.add_argument('--output_dir', '-o', type=str, default='alignments')
+    parser.add_argument('--workers', '-j', type=int, default=os.cpu_count())
+    parser.add_argument('--manifest', '-m', type=str, default=None,
+                        help='default: OUTPUT_DIR/manifest.jsonl')
+    parser.add_argument('--max_lev', type=int, default=None)
+    parser.add_argument('--matcher', choices=MATCHERS, default='greedy')
+    parser.add_argument('--chain', action='store_true',
+                        help='One job per issue: load each version once and '
+                             'write alignments and diff sets of all '
+                             'adjacent version pairs')
+    parser.add_argument('--diff_backend', choices=DIFF_BACKENDS,
+                        default='difflib',
+                        help='Character diff implementation for --chain')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    if len(args.version_dirs) < 2:
+        parser.error('at least two version directories are needed')
+    if args.labels is None:
+        args.labels = [version_label(d) for d in args.version_dirs]
+    elif len(args.labels) != len(args.version_dirs):
+        parser.error('one label is needed per version directory')
+    if args.manifest is None:
+        args.manifest = args.output_dir + '/manifest.jsonl'
+    return args
+
+
+def main():
+    args = argparser()
+    instrument.setup(args, 'align_ocrs')
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    start_t = time.time()
+    counts = {'ok': 0, 'failed': 0, 'skipped': 0}
+
+    with (open(args.manifest, 'a', encoding='utf-8') as manifest,
+          ProcessPoolExecutor(args.workers,
+                              initializer=init_worker) as executor):
+        if args.chain:
+            jobs = list_chain_jobs
+            run = partial(run_chain_job, diff_backend=args.diff_backend,
+                          matcher=args.matcher)
+        else:
+            jobs = list_jobs
+            run = partial(run_job, matcher=args.matcher)
+        jobs = list(jobs(args.version_dirs, args.labels, args.glob,
+                         args.output_dir))
+        try:
+            check_outputs(jobs)
+        except ValueError as e:
+            sys.exit(e)
+        futures = []
+        for job in jobs:
+            if Path(job['output']).exists():
+                counts['skipped'] += 1
+                continue
+            futures.append(executor.submit(run, job, args.output_dir,
+                                           args.max_lev))
+        print(f'{len(futures)} jobs, {counts["skipped"]} already done')
+
+        for future in as_completed(futures):
+            result = future.result()
+            counts[result['status']] += 1
+            if result['status'] == 'failed':
+                print(result.get('files') or [result['a_file'],
+                                              result['b_file']],
+                      result['error'])
+            print(json.dumps(result, ensure_ascii=False), file=manifest,
+                  flush=True)
+
+    print(counts, "Time", time.time() - start_t)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+'''
+Benchmarks of the pipeline stages on synthetic pages.
+
+    python bench/run_bench.py --lines 50 100 200 400 800 \
+        -o bench/results/$(git rev-parse --short HEAD).json
+    python bench/run_bench.py --compare bench/results/OLD.json
+
+For every page size, a page and a noisy second version of it are generated
+(see synthetic.py), and each stage is timed on them (best of --repeat
+runs). The peak memory allocated by one run is measured separately with
+tracemalloc. The stages are:
+
+    restructure_pdf    extraction of a PDF page of the text (needs PyMuPDF)
+    list_lines         listing the line dicts of both versions
+    page_lines         listing the lines of both versions as PageLines
+    match              candidate pairs and greedy matching of align_lines
+    match_optimal      the same with the sparse-optimal matcher
+    align_1_2          1:2 alignment of the lines left unpaired
+    align_pages        the whole alignment of the page
+    diff_page          line diffs and alternatives of diff_lines
+    evaluate_alt_sets  winner selection of evaluate_diffs, stub perplexities
+
+The results are printed as scaling curves (lines per page against time and
+memory), and saved as JSON with the commit, so that runs of different
+commits can be compared with --compare.
+'''
+import argparse
+import io
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from pathlib import Path
+from sys import path
+
+from synthetic import make_page, noisy_version
+
+path.append(str(Path(__file__).resolve().parents[1]))
+from align.align_lines import (align_1_2, align_pages, candidate_pairs,
+                               exact_pairs, find_unpaired, greedy_match,
+                               list_lines, near_pairs, page_lines,
+                               sparse_optimal_match)
+from diff_lines import diff_page
+from evaluate_diffs import eval_input, evaluate_alt_sets
+from scoring_service import StubModel
+
+try:
+    import fitz
+    from pdf_extract.pdf_extract import restructure_pdf
+except ImportError:
+    fitz = None
+
+STAGES = ['restructure_pdf', 'list_lines', 'page_lines', 'match',
+          'match_optimal', 'align_1_2', 'align_pages', 'diff_page',
+          'evaluate_alt_sets']
+
+
+def pdf_page(page):
+    '''A one page PDF with the text of the lines at their origins.'''
+    pdf_document = fitz.open()
+    pdf_page = pdf_document.new_page(width=page['cropbox'][2],
+                                     height=page['cropbox'][3])
+    for block in page['blocks']:
+        for line in block['lines']:
+            pdf_page.insert_text(line['origin'], line['text'], fontsize=8)
+    return pdf_document
+
+
+def match(a_lines, b_lines, matcher=greedy_match):
+    rows, cols, costs = candidate_pairs(a_lines.center, b_lines.center,
+                                        a_lines.no_space, b_lines.no_space)
+    return matcher(rows, cols, costs)
+
+
+def num_unpaired(pairs):
+    return len(pairs[None]) + sum(1 for v in pairs.values() if v is None)
+
+
+def stage_runs(a_page, b_page):
+    '''
+    A function per stage, which prepares its inputs and returns the
+    function to be measured.
+    '''
+    a_lines = page_lines([a_page], 0, verbose=False)
+    b_lines = page_lines([b_page], 0, verbose=False)
+
+    def prepare_align_1_2():
+        # align_1_2 rewrites the lines it concatenates
+        a_copy = a_lines.copy()
+        b_copy = b_lines.copy()
+        pairs = {int(i): int(j) for i, j, _ in match(a_copy, b_copy)}
+        unpaired_a, unpaired_b = find_unpaired(a_copy, b_copy, pairs)
+        return lambda: align_1_2(unpaired_b, unpaired_a, b_copy, a_copy,
+                                 'B', 'A', verbose=False)
+
+    pairs = align_pages(a_lines, b_lines)
+    alt_sets = diff_page(pairs, a_lines, b_lines)
+    doc = eval_input({'a_label': 'A', 'b_label': 'B'}, alt_sets)
+    perplexities = [pred['substr-perpl'] for pred in
+                    StubModel().predict_subsequences(doc['sequences'])]
+
+    runs = {
+        'list_lines': lambda: lambda: (list_lines(a_page, verbose=False),
+                                       list_lines(b_page, verbose=False)),
+        'page_lines': lambda: lambda: (
+            page_lines([a_page], 0, verbose=False),
+            page_lines([b_page], 0, verbose=False)),
+        'match': lambda: lambda: match(a_lines, b_lines),
+        'match_optimal': lambda: lambda: match(a_lines, b_lines,
+                                               sparse_optimal_match),
+        'align_1_2': prepare_align_1_2,
+        'align_pages': lambda: lambda: align_pages(a_lines, b_lines),
+        'diff_page': lambda: lambda: diff_page(pairs, a_lines, b_lines),
+        'evaluate_alt_sets': lambda: lambda: evaluate_alt_sets(
+            doc, perplexities, io.StringIO())}
+    if fitz is not None:
+        pdf_document = pdf_page(a_page)
+        runs['restructure_pdf'] = lambda: lambda: restructure_pdf(
+            pdf_document[0])
+    counts = {'a_lines': len(a_lines), 'b_lines': len(b_lines),
+              'exact_pairs': int(exact_pairs(
+                  *near_pairs(a_lines.center, b_lines.center),
+                  a_lines.no_space, b_lines.no_space).sum()),
+              'pairs': sum(1 for k, v in pairs.items()
+                           if k is not None and v is not None),
+              'unpaired': num_unpaired(pairs),
+              'unpaired_optimal': num_unpaired(align_pages(
+                  a_lines, b_lines, matcher='sparse-optimal')),
+              'alt_sets': len(alt_sets),
+              'alternatives': len(doc['sequences'])}
+    return runs, counts
+
+
+def measure(prepare, repeat):
+    seconds = []
+    for _ in range(repeat):
+        run = prepare()
+        start_t = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start_t)
+    run = prepare()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(seconds), peak
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        return None
+
+
+def print_curves(results, baseline=None):
+    old = {}
+    if baseline is not None:
+        old = {(result['stage'], result['lines']): result
+               for result in baseline['results']}
+    header = 'stage\tlines\tms\tpeak KiB'
+    print(header + ('\told ms\tratio' if baseline is not None else ''))
+    for result in results:
+        row = [result['stage'], str(result['lines']),
+               f"{result['seconds'] * 1000:.3f}",
+               f"{result['peak_bytes'] / 1024:.0f}"]
+        prev = old.get((result['stage'], result['lines']))
+        if prev is not None:
+            row += [f"{prev['seconds'] * 1000:.3f}",
+                    f"{result['seconds'] / prev['seconds']:.2f}"]
+        print('\t'.join(row))
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, nargs='+',
+                        default=[50, 100, 200, 400, 800],
+                        help='Lines per page')
+    parser.add_argument('--columns', type=int, default=2)
+    parser.add_argument('--noise', type=float, default=0.02,
+                        help='Rate of misread characters')
+    parser.add_argument('--split_rate', type=float, default=0.02,
+                        help='Rate of lines split in two')
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+                        default=STAGES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help='Save the results as JSON')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Results JSON of an earlier run to compare to')
+    return parser.parse_args()
+
+
+def main():
+    args = argparser()
+    results = []
+    for num_lines in args.lines:
+        a_page = make_page(num_lines, args.columns, seed=args.seed)
+        b_page = noisy_version(a_page, args.noise, args.split_rate,
+                               seed=args.seed + 1)
+        runs, counts = stage_runs(a_page, b_page)
+        for stage in args.stages:
+            if stage not in runs:
+                continue
+            seconds, peak = measure(runs[stage], args.repeat)
+            results.append({'stage': stage, 'lines': num_lines,
+                            'seconds': seconds, 'peak_bytes': peak,
+                            'counts': counts})
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_curves(sorted(results, key=lambda r: STAGES.index(r['stage'])),
+                 baseline)
+
+    if args.output is not None:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, 'w') as out:
+            json.dump({'commit': git_commit(),
+                       'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'params': {'columns': args.columns,
+                                  'noise': args.noise,
+                                  'split_rate': args.split_rate,
+                                  'repeat': args.repeat,
+                                  'seed': args.seed},
+                       'results': results}, out, indent=1)
+
+
+if __name__ == '__main__':
+    main()
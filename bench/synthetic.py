@@ -0,0 +1,134 @@
+'''
+Synthetic page layouts for the benchmarks.
+
+make_page builds a page in the shape written by pdf_extract.restructure_pdf
+(cropbox, blocks of lines with bbox, origin, center and text), with a given
+number of lines set in columns. noisy_version makes a second OCR version of
+it: characters are misread, dropped or inserted at noise_rate, coordinates
+are jittered, and some lines are split in two on the same row, as the
+OCR engines do with wide spacing.
+'''
+import random
+
+PAGE_WIDTH = 595.0
+PAGE_HEIGHT = 842.0
+MARGIN = 40.0
+LINE_HEIGHT = 11.0
+CHAR_WIDTH = 4.5
+COLUMN_GAP = 12.0
+LINES_PER_BLOCK = 8
+WORDS = ('a az és hogy nem is egy meg volt de már csak még mint van '
+         'lesz után között szerint magyar ország város idő élet év nap '
+         'kormány gazdaság választás miniszter ügy kérdés rész alapján '
+         'szerkesztőség fotó budapest tavaly mindig lehet kell először '
+         'őszinte üzlet főváros művész költő lányok fiúk').split()
+# typical OCR confusions, in both directions
+CONFUSIONS = [('l', '1'), ('l', 'I'), ('rn', 'm'), ('ő', 'ó'), ('ű', 'ú'),
+              ('é', 'e'), ('o', '0'), ('c', 'e'), ('f', 't'), ('i', 'í'),
+              (',', '.'), ('"', '”')]
+
+
+def line_text(rng, num_chars):
+    words = []
+    length = 0
+    while length < num_chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    text = ' '.join(words)[:num_chars]
+    return text[0].upper() + text[1:]
+
+
+def make_line(x0, y0, text):
+    bbox = (x0, y0, x0 + len(text) * CHAR_WIDTH, y0 + LINE_HEIGHT)
+    return {'origin': (x0, y0 + LINE_HEIGHT * 0.8),
+            'bbox': bbox,
+            'text': text,
+            'center': ((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)}
+
+
+def make_block(number, lines):
+    return {'number': number,
+            'lines': lines,
+            'bbox': (min(line['bbox'][0] for line in lines),
+                     min(line['bbox'][1] for line in lines),
+                     max(line['bbox'][2] for line in lines),
+                     max(line['bbox'][3] for line in lines))}
+
+
+def make_page(num_lines, columns=2, seed=0):
+    '''A page of num_lines lines of text in columns of blocks.'''
+    rng = random.Random(seed)
+    column_width = ((PAGE_WIDTH - 2 * MARGIN - (columns - 1) * COLUMN_GAP)
+                    / columns)
+    chars_per_line = max(int(column_width / CHAR_WIDTH), 1)
+    lines_per_column = -(-num_lines // columns)
+    # lines are squeezed together when they do not fit on the page
+    line_step = min(LINE_HEIGHT * 1.2,
+                    (PAGE_HEIGHT - 2 * MARGIN) / max(lines_per_column, 1))
+    blocks = []
+    block_lines = []
+    for line_num in range(num_lines):
+        column, row = divmod(line_num, lines_per_column)
+        x0 = MARGIN + column * (column_width + COLUMN_GAP)
+        y0 = MARGIN + row * line_step
+        block_lines.append(make_line(x0, y0, line_text(
+            rng, rng.randint(chars_per_line // 2, chars_per_line))))
+        if (len(block_lines) == LINES_PER_BLOCK or row == lines_per_column - 1
+                or line_num == num_lines - 1):
+            blocks.append(make_block(len(blocks), block_lines))
+            block_lines = []
+    return {'cropbox': (0.0, 0.0, PAGE_WIDTH, PAGE_HEIGHT), 'blocks': blocks}
+
+
+def noisy_text(rng, text, noise_rate):
+    out = []
+    ix = 0
+    while ix < len(text):
+        if rng.random() >= noise_rate:
+            out.append(text[ix])
+            ix += 1
+            continue
+        action = rng.random()
+        if action < 0.6:
+            for one, another in CONFUSIONS:
+                if text.startswith(one, ix):
+                    out.append(another)
+                    ix += len(one)
+                    break
+                if text.startswith(another, ix):
+                    out.append(one)
+                    ix += len(another)
+                    break
+            else:
+                out.append(text[ix])
+                ix += 1
+        elif action < 0.8:  # dropped character
+            ix += 1
+        else:  # inserted character
+            out.append(rng.choice(' .,\'-'))
+    return ''.join(out)
+
+
+def noisy_version(page, noise_rate=0.02, split_rate=0.02, jitter=1.0,
+                  seed=1):
+    '''A second OCR version of page.'''
+    rng = random.Random(seed)
+    blocks = []
+    for block in page['blocks']:
+        lines = []
+        for line in block['lines']:
+            text = noisy_text(rng, line['text'], noise_rate) or '.'
+            dx = rng.uniform(-jitter, jitter)
+            dy = rng.uniform(-jitter, jitter)
+            x0 = line['bbox'][0] + dx
+            y0 = line['bbox'][1] + dy
+            split = text.find(' ', len(text) // 2)
+            if rng.random() < split_rate and split > 0:
+                lines.append(make_line(x0, y0, text[:split]))
+                lines.append(make_line(
+                    x0 + (split + 1) * CHAR_WIDTH, y0, text[split + 1:]))
+            else:
+                lines.append(make_line(x0, y0, text))
+        blocks.append(make_block(block['number'], lines))
+    return {'cropbox': page['cropbox'], 'blocks': blocks}
@@ -0,0 +1,89 @@
+'''
+Compare the segmentations of two character diff backends of diff_lines.
+
+    python compare_diff_backends.py alignments/*_FR15_FR16.json
+
+Every line pair that diff_lines would diff is segmented by both backends.
+The report shows how often the segmentations differ, how often only one of
+them exceeds MAX_DIFFS_PER_LINE (the line is dropped), and the most common
+(a, b) differences found by only one of the backends.
+'''
+import argparse
+import json
+import time
+from collections import Counter
+
+from diff_lines import (DIFF_BACKENDS, MAX_DIFFS_PER_LINE, diff_segments,
+                        diffable, line_pairs, load_pages)
+
+
+def seg_diffs(segs):
+    return [(seg['a'], seg['b']) for seg in segs if seg.tag != 'equal']
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('alignment_files', nargs='+')
+    parser.add_argument('--backends', nargs=2, choices=DIFF_BACKENDS,
+                        default=['difflib', 'levenshtein'])
+    parser.add_argument('--top', type=int, default=20,
+                        help='Number of differences listed per backend')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Print every line pair segmented differently')
+    return parser.parse_args()
+
+
+def main():
+    args = argparser()
+    ref, alt = args.backends
+    counts = Counter()
+    seconds = Counter()
+    only_in = {ref: Counter(), alt: Counter()}
+
+    for alignment_fname in args.alignment_files:
+        with open(alignment_fname) as alignment_file:
+            alignment = json.load(alignment_file)
+        a_pages, b_pages = load_pages(alignment)
+        for page, a_page, b_page in zip(alignment['pages'], a_pages, b_pages):
+            for a_text, b_text, *_ in line_pairs(page, a_page, b_page):
+                if a_text == b_text or not diffable(a_text, b_text):
+                    continue
+                counts['line pairs'] += 1
+                diffs = {}
+                for backend in (ref, alt):
+                    start_t = time.perf_counter()
+                    segs = diff_segments(a_text, b_text, backend)
+                    seconds[backend] += time.perf_counter() - start_t
+                    diffs[backend] = seg_diffs(segs)
+                    if len(diffs[backend]) > MAX_DIFFS_PER_LINE:
+                        counts[f'dropped by {backend}'] += 1
+                if diffs[ref] == diffs[alt]:
+                    continue
+                counts['different segmentation'] += 1
+                if len(diffs[ref]) != len(diffs[alt]):
+                    counts['different number of diffs'] += 1
+                only_in[ref].update(set(diffs[ref]) - set(diffs[alt]))
+                only_in[alt].update(set(diffs[alt]) - set(diffs[ref]))
+                if args.verbose:
+                    print('A:', a_text)
+                    print('B:', b_text)
+                    for backend in (ref, alt):
+                        print(f'  {backend}:', diffs[backend])
+                    print()
+
+    total = counts['line pairs'] or 1
+    for key in ['line pairs', 'different segmentation',
+                'different number of diffs',
+                f'dropped by {ref}', f'dropped by {alt}']:
+        print(f'{key}\t{counts[key]}\t{counts[key] / total:.2%}')
+    for backend in (ref, alt):
+        print(f'{backend} seconds\t{seconds[backend]:.3f}')
+    for backend in (ref, alt):
+        print()
+        print(f'Differences found only by {backend}:')
+        for (a, b), freq in only_in[backend].most_common(args.top):
+            print(f'{freq}\t›{a}‹\t›{b}‹')
+
+
+if __name__ == '__main__':
+    main()
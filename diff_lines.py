@@ -1,8 +1,18 @@
+import os
 import json
-from sys import argv
-from align.align_lines import list_lines
-import networkx as nx
+import time
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+from pathlib import Path
+from sys import stderr
+from align.align_lines import page_lines
+from align.layout_cache import load_document
+import instrument
+from itertools import product
 import difflib
+import Levenshtein
 from Levenshtein import distance
 
 # left/right context required by the LM to decide on a target sequence
@@ -14,6 +24,8 @@ TARGET_CONTEXT = 5
 MAX_DIFFS_PER_LINE = 6
 MAX_DIST_PER_LINE = 20
 MAX_DIST_RATIO = 0.5
+# pages of an alignment diffed by one task in directory mode
+PAGES_PER_TASK = 50
 
 class DiffSegment:
     '''A class that provides a comfortable interface for difflib diffs.'''
@@ -59,75 +71,24 @@ class DiffSegment:
         return msg
 
 
-def diffs_to_graph(segs, a_label='a', b_label='b'):
-    graph = nx.DiGraph()
-    node_text = {}
-    node_source = {}
-    graph.add_node(0)
-    current_node = 0
+def diff_variants(segs, a_label='a', b_label='b'):
+    '''
+    Generate every variant of a line that takes each differing segment
+    from either a or b, together with the sources of the choices made.
+    Variants come in the order a before b, the first difference varying
+    slowest.
+    '''
+    choices = []
     for seg in segs:
         if seg.tag == 'equal':
-            next_node = current_node + 1
-            graph.add_node(next_node)
-            node_text[next_node] = seg['a']
-            graph.add_edge(current_node, next_node)
-            current_node = next_node
-        elif seg.tag == 'replace':
-            a_node = current_node + 1
-            b_node = current_node + 2
-            join_node = current_node + 3
-            graph.add_node(a_node)
-            graph.add_node(b_node)
-            graph.add_node(join_node, text='')
-            node_text[a_node] = seg['a']
-            node_text[b_node] = seg['b']
-            node_source[a_node] = a_label
-            node_source[b_node] = b_label
-            graph.add_edge(current_node, a_node)
-            graph.add_edge(current_node, b_node)
-            graph.add_edge(a_node, join_node)
-            graph.add_edge(b_node, join_node)
-            current_node = join_node
-        elif seg.tag == 'insert':
-            a_node = current_node + 1
-            b_node = current_node + 2
-            join_node = current_node + 3
-            graph.add_node(a_node)
-            graph.add_node(b_node)
-            graph.add_node(join_node)
-            node_text[b_node] = seg['b']
-            node_source[a_node] = a_label
-            node_source[b_node] = b_label
-            graph.add_edge(current_node, a_node)
-            graph.add_edge(current_node, b_node)
-            graph.add_edge(a_node, join_node)
-            graph.add_edge(b_node, join_node)
-            current_node = join_node
-        elif seg.tag == 'delete':
-            a_node = current_node + 1
-            b_node = current_node + 2
-            join_node = current_node + 3
-            graph.add_node(a_node)
-            graph.add_node(b_node)
-            graph.add_node(join_node)
-            node_text[a_node] = seg['a']
-            node_source[a_node] = a_label
-            node_source[b_node] = b_label
-            graph.add_edge(current_node, a_node)
-            graph.add_edge(current_node, b_node)
-            graph.add_edge(a_node, join_node)
-            graph.add_edge(b_node, join_node)
-            current_node = join_node
-    return graph, node_text, node_source
-
-
-def graph_paths(graph, node_text, node_source):
+            choices.append([(seg['a'], '')])
+        else:  # replace, insert, delete
+            choices.append([(seg['a'], a_label), (seg['b'], b_label)])
     path_texts = []
     path_sources = []
-    for path in list(nx.all_simple_paths(graph, source=0,
-                                         target=list(graph.nodes)[-1])):
-        path_texts.append(''.join([node_text.get(e, '') for e in path]))
-        path_sources.append(''.join([node_source.get(e, '') for e in path]))
+    for variant in product(*choices):
+        path_texts.append(''.join(text for text, _ in variant))
+        path_sources.append(''.join(source for _, source in variant))
     return path_texts, path_sources
 
 
@@ -178,232 +139,536 @@ def remove_hyphen(text, r_context):
 def clean_str(s):
     return s.strip().replace('\xad', '-')
 
-def main():
-    print(argv[1])
-    with open(argv[1]) as alignment_file:
-        alignment = json.load(alignment_file)
 
-    with open(alignment['a_file']) as a_file:
-        a_data = json.load(a_file)
+def line_pairs(page, a_page, b_page):
+    '''
+    Yield the texts of the aligned line pairs of a page, with the indices
+    of the lines before and after them in both versions.
+    '''
+    for k, v in page.items():
+        # alignments loaded from JSON have 'null' and string keys
+        if k is None or k == 'null' or v is None:
+            continue
+        k = str(k)
+        if '+' in k:
+            a_lines = k.split('+')
+            a_lines = [int(a_lines[0]), int(a_lines[1])]
+            a_text = clean_str(a_page.texts[a_lines[0]]
+                               + a_page.texts[a_lines[1]])
+            a_prev_line = a_lines[0] - 1
+            a_next_line = a_lines[1] + 1
+        else:
+            a_text = clean_str(a_page.texts[int(k)])
+            a_prev_line = int(k) - 1
+            a_next_line = int(k) + 1
+        if type(v) == str and '+' in v:
+            b_lines = v.split('+')
+            b_lines = [int(b_lines[0]), int(b_lines[1])]
+            b_text = clean_str(b_page.texts[b_lines[0]]
+                               + b_page.texts[b_lines[1]])
+            b_prev_line = b_lines[0] - 1
+            b_next_line = b_lines[1] + 1
+        else:
+            b_text = clean_str(b_page.texts[int(v)])
+            b_prev_line = int(v) - 1
+            b_next_line = int(v) + 1
+
+        yield (a_text, b_text,
+               a_prev_line, a_next_line, b_prev_line, b_next_line)
+
+
+def diffable(a_text, b_text):
+    '''Whether two different line texts are close enough to be diffed.'''
+    lev_dist = distance(a_text, b_text)
+    return not (lev_dist > MAX_DIST_PER_LINE
+                or lev_dist > min(len(a_text), len(b_text)) * MAX_DIST_RATIO)
+
+
+def difflib_opcodes(a_text, b_text):
+    matcher = difflib.SequenceMatcher(autojunk=False)
+    matcher.set_seqs(a_text, b_text)
+    return matcher.get_opcodes()
+
+
+def levenshtein_opcodes(a_text, b_text):
+    '''
+    Opcodes of a minimal edit script, computed by the compiled Levenshtein
+    module. Adjacent edits are merged into one segment, as difflib never
+    returns two differing segments next to each other.
+    '''
+    opcodes = []
+    for tag, i1, i2, j1, j2 in Levenshtein.opcodes(a_text, b_text):
+        if tag != 'equal' and opcodes and opcodes[-1][0] != 'equal':
+            _, i1, _, j1, _ = opcodes.pop()
+            if i1 == i2:
+                tag = 'insert'
+            elif j1 == j2:
+                tag = 'delete'
+            else:
+                tag = 'replace'
+        opcodes.append((tag, i1, i2, j1, j2))
+    return opcodes
+
+
+# difflib is the reference backend the published statistics were made with
+DIFF_BACKENDS = {'difflib': difflib_opcodes,
+                 'levenshtein': levenshtein_opcodes}
+
+
+def diff_segments(a_text, b_text, backend='difflib'):
+    return [DiffSegment(*opcode, a_text, b_text)
+            for opcode in DIFF_BACKENDS[backend](a_text, b_text)]
+
+
+def diff_page(page, a_page, b_page, backend='difflib'):
+    '''
+    Collect the alternative sets of the differing line pairs of one page.
+    page is the page's pairs dict from the alignment, a_page and b_page
+    are the page_lines output of the page in the two versions. backend is
+    one of DIFF_BACKENDS.
+    '''
+    alt_sets = []
+    for (a_text, b_text, a_prev_line, a_next_line,
+         b_prev_line, b_next_line) in line_pairs(page, a_page, b_page):
+        instrument.count('line_pairs')
+        if a_text == b_text:
+            continue
+
+        if not diffable(a_text, b_text):
+            continue
+
+        with instrument.timed('diff_segments'):
+            segs = diff_segments(a_text, b_text, backend)
+        num_diffs = sum(1 for seg in segs if seg.tag != 'equal')
+        if num_diffs > MAX_DIFFS_PER_LINE:
+            instrument.count('too_many_diffs')
+            continue
+
+        path_texts, path_sources = diff_variants(segs)
+#            print(num_diffs, len(path_texts), get_diff_string(segs))
 
-    with open(alignment['b_file']) as b_file:
-        b_data = json.load(b_file)
+        diff_list = [{'a': seg["a"], 'b': seg['b']}
+                        for seg in segs
+                        if seg.tag != 'equal']
 
-    diff_dict = {
-        'alignment_file': argv[1],
-        'a_label': alignment['a_label'],
-        'b_label': alignment['b_label'],
-        'alt_sets': []}
+        alt_sets.append(
+            {'a_text': a_text, 'b_text': b_text, 'diffs': diff_list,
+             'context': '', 'alternatives': []})
 
-    for page_num, page in enumerate(alignment['pages']):
-#        print("page", page_num)
-        a_page = list_lines(a_data['pages'][page_num], verbose=False)
-        b_page = list_lines(b_data['pages'][page_num], verbose=False)
+        # if the line starts with a difference
+        if segs[0].tag != 'equal':
+            diff_start = 0
+        else:
+            diff_start = len(segs[0]['a'])
 
-        for k, v in page.items():
-            if k == 'null' or v is None:
-                continue
-            if '+' in k:
-                a_lines = k.split('+')
-                a_lines = [int(a_lines[0]), int(a_lines[1])]
-                a_text = clean_str(a_page[a_lines[0]]['text']
-                                   + a_page[a_lines[1]]['text'])
-                a_prev_line = a_lines[0] - 1
-                a_next_line = a_lines[1] + 1
-            else:
-                a_text = clean_str(a_page[int(k)]['text'])
-                a_prev_line = int(k) - 1
-                a_next_line = int(k) + 1
-            if type(v) == str and '+' in v:
-                b_lines = v.split('+')
-                b_lines = [int(b_lines[0]), int(b_lines[1])]
-                b_text = clean_str(b_page[b_lines[0]]['text']
-                                   + b_page[b_lines[1]]['text'])
-                b_prev_line = b_lines[0] - 1
-                b_next_line = b_lines[1] + 1
-            else:
-                b_text = clean_str(b_page[int(v)]['text'])
-                b_prev_line = int(v) - 1
-                b_next_line = int(v) + 1
+        # if the line ends with a difference
+        if segs[-1].tag != 'equal':
+            diff_end = 0   # counting from the end
+        else:
+            diff_end = len(segs[-1]['a'])
 
-            if a_text == b_text:
-                continue
+        # add previous line for additional left context if necessary
+        l_missing = TARGET_CONTEXT + LR_CONTEXT - diff_start
 
-            lev_dist = distance(a_text, b_text)
-            if (lev_dist > MAX_DIST_PER_LINE
-                or lev_dist > min(len(a_text), len(b_text)) * MAX_DIST_RATIO):
-                continue
+        a_prev_text = ''
+        if a_prev_line >= 0:
+            a_prev_text = clean_str(a_page.texts[a_prev_line])
 
-            matcher = difflib.SequenceMatcher(autojunk=False)
-            matcher.set_seqs(a_text, b_text)
-            opcodes = matcher.get_opcodes()
-            segs = [DiffSegment(*opcode, a_text, b_text)
-                    for opcode in opcodes]
-            num_diffs = sum(1 for seg in segs if seg.tag != 'equal')
-            if num_diffs > MAX_DIFFS_PER_LINE:
-                continue
+        b_prev_text = ''
+        if b_prev_line >= 0:
+            b_prev_text = clean_str(b_page.texts[b_prev_line])
 
-            graph, node_text, node_source = diffs_to_graph(segs)
-            path_texts, path_sources = graph_paths(graph, node_text,
-                                                   node_source)
-#            print(num_diffs, len(path_texts), get_diff_string(segs))
+        a_next_text = ''
+        if a_next_line < len(a_page):
+            a_next_text = clean_str(a_page.texts[a_next_line])
 
-            diff_list = [{'a': seg["a"], 'b': seg['b']}
-                            for seg in segs
-                            if seg.tag != 'equal']
+        b_next_text = ''
+        if b_next_line < len(b_page):
+            b_next_text = clean_str(b_page.texts[b_next_line])
 
-            diff_dict['alt_sets'].append(
-                {'a_text': a_text, 'b_text': b_text, 'diffs': diff_list,
-                 'context': '', 'alternatives': []})
-
-            ROOT_NODE = 0
-            # if root branches immediately
-            if len(graph[ROOT_NODE]) == 2:
-                diff_start = 0
+        if l_missing <= 0:
+            l_context = ['']
+        elif a_prev_text == b_prev_text and a_next_text == b_next_text:
+            l_context = [a_prev_text]
+        else:
+            l_context = [a_prev_text, b_prev_text]
+        
+        for ix, prev_line in enumerate(l_context):
+            if (len(prev_line) > 2
+                and prev_line[-1] == '-'
+                and prev_line [-2] != ' '):
+                if ((prev_line.endswith('sz-')
+                    and (a_text.startswith('sz')
+                         or b_text.startswith('sz')))
+                    or
+                    (prev_line.endswith('zs-')
+                    and (a_text.startswith('zs')
+                         or b_text.startswith('zs')))
+                    or
+                    (prev_line.endswith('cs-')
+                    and (a_text.startswith('cs')
+                         or b_text.startswith('cs')))
+                    or
+                    (prev_line[-2] == 'y'
+                    and
+                    (prev_line.endswith('gy-')
+                    and (a_text.startswith('gy')
+                         or b_text.startswith('gy')))
+                    or
+                    (prev_line.endswith('ny-')
+                    and (a_text.startswith('ny')
+                         or b_text.startswith('ny')))
+                    or
+                    (prev_line.endswith('ty-')
+                    and (a_text.startswith('ty')
+                         or b_text.startswith('ty')))
+                    or
+                    (prev_line.endswith('ly-')
+                    and (a_text.startswith('ly')
+                         or b_text.startswith('ly'))))
+                ):
+                    l_context[ix] = prev_line[:-2]
+                elif prev_line[-2].isupper() or prev_line[-2].isnumeric():
+                    l_context[ix] = prev_line
+                else:
+                    l_context[ix] = prev_line[:-1]
             else:
-                diff_start = len(node_text[1])
-            
-            final_node = list(graph.nodes)[-1]
+                l_context[ix] = prev_line + ' '
 
-            # if final node has two parents
-            if len(list(graph.predecessors(final_node))) == 2:
-                diff_end = 0   # counting from the end
-            else:
-                diff_end = len(node_text[final_node])
+        eval_start = []
+        for prev_line in l_context:
+            eval_start.append(max(0, diff_start + len(prev_line)
+                                  - TARGET_CONTEXT))
 
-            # add previous line for additional left context if necessary
-            l_missing = TARGET_CONTEXT + LR_CONTEXT - diff_start
+        # add next line for additional right context if necessary
+        r_missing = TARGET_CONTEXT + LR_CONTEXT - diff_end
 
-            a_prev_text = ''
-            if a_prev_line >= 0:
-                a_prev_text = clean_str(a_page[a_prev_line]['text'])
+        if r_missing <= 0:
+            r_context = ['']
+        elif a_prev_text == b_prev_text and a_next_text == b_next_text:
+            r_context = [a_next_text]
+        else:
+            r_context = [a_next_text, b_next_text]
+        
+        # check whether a_text and b_text end in a hyphen
 
-            b_prev_text = ''
-            if b_prev_line >= 0:
-                b_prev_text = clean_str(b_page[b_prev_line]['text'])
+        _, a_removed = remove_hyphen(a_text, r_context)
+        _, b_removed = remove_hyphen(b_text, r_context)
 
-            a_next_text = ''
-            if a_next_line < len(a_page):
-                a_next_text = clean_str(a_page[a_next_line]['text'])
+        # generate alternatives
 
-            b_next_text = ''
-            if b_next_line < len(b_page):
-                b_next_text = clean_str(b_page[b_next_line]['text'])
+        alt_sets[-1]['context'] =\
+            ' // '.join([l_context[0],
+                         get_diff_string(segs),
+                         r_context[0]])
 
-            if l_missing <= 0:
-                l_context = ['']
-            elif a_prev_text == b_prev_text and a_next_text == b_next_text:
-                l_context = [a_prev_text]
-            else:
-                l_context = [a_prev_text, b_prev_text]
-            
-            for ix, prev_line in enumerate(l_context):
-                if (len(prev_line) > 2
-                    and prev_line[-1] == '-'
-                    and prev_line [-2] != ' '):
-                    if ((prev_line.endswith('sz-')
-                        and (a_text.startswith('sz')
-                             or b_text.startswith('sz')))
-                        or
-                        (prev_line.endswith('zs-')
-                        and (a_text.startswith('zs')
-                             or b_text.startswith('zs')))
-                        or
-                        (prev_line.endswith('cs-')
-                        and (a_text.startswith('cs')
-                             or b_text.startswith('cs')))
-                        or
-                        (prev_line[-2] == 'y'
-                        and
-                        (prev_line.endswith('gy-')
-                        and (a_text.startswith('gy')
-                             or b_text.startswith('gy')))
-                        or
-                        (prev_line.endswith('ny-')
-                        and (a_text.startswith('ny')
-                             or b_text.startswith('ny')))
-                        or
-                        (prev_line.endswith('ty-')
-                        and (a_text.startswith('ty')
-                             or b_text.startswith('ty')))
-                        or
-                        (prev_line.endswith('ly-')
-                        and (a_text.startswith('ly')
-                             or b_text.startswith('ly'))))
-                    ):
-                        l_context[ix] = prev_line[:-2]
-                    elif prev_line[-2].isupper() or prev_line[-2].isnumeric():
-                        l_context[ix] = prev_line
+        for text_variant, sources in zip(path_texts, path_sources):
+            for lc, rc, start in zip(l_context, r_context, eval_start):
+                if a_removed >= 0 and sources[-1] == 'a':
+                    if a_removed:
+                        center = text_variant[:-a_removed]
                     else:
-                        l_context[ix] = prev_line[:-1]
+                        center = text_variant
+                    end = max(0, diff_end - TARGET_CONTEXT + len(rc)
+                              - a_removed)
+                elif b_removed >= 0 and sources[-1] == 'b':
+                    if b_removed:
+                        center = text_variant[:-b_removed]
+                    else:
+                        center = text_variant
+                    end = max(0, diff_end - TARGET_CONTEXT + len(rc)
+                              - b_removed)
                 else:
-                    l_context[ix] = prev_line + ' '
+                    center = text_variant + ' '
+                    end = max(0, diff_end - TARGET_CONTEXT + len(rc) + 1)
+                concat_text = lc + center + rc
+                conc_end = len(concat_text) - end
+                # print('CENT', center)
+                # print('LC:', lc)
+                # print('RC:', rc)
+                # print('CC:', concat_text)
+                # eval_span = (concat_text[:start] + '##'
+                #              + concat_text[start:conc_end] + '##'
+                #              + concat_text[conc_end:])
+                # print(eval_span)
+                # print(f"{sources}, {start}, {conc_end}")
+
+                alt_sets[-1]['alternatives'].append(
+                    {'text': concat_text, 'sources': sources,
+                     'start': start, 'end': conc_end})
+        instrument.count('diffs', num_diffs)
+        instrument.count('alternatives', len(alt_sets[-1]['alternatives']))
+    instrument.count('alt_sets', len(alt_sets))
+    return alt_sets
+
+
+def diff_documents(alignment, a_pages, b_pages, backend='difflib'):
+    '''
+    Collect the alternative sets of all pages of an alignment.
+    a_pages and b_pages hold the page_lines output of every page.
+    '''
+    alt_sets = []
+    for page_num, page in enumerate(alignment['pages']):
+#        print("page", page_num)
+        with instrument.page(page_num):
+            alt_sets.extend(diff_page(page, a_pages[page_num],
+                                      b_pages[page_num], backend))
+    return alt_sets
+
+
+def diffs_fname(alignment_fname, jsonl=False):
+    return (alignment_fname[:-len('.json')]
+            + ('_diffs.jsonl' if jsonl else '_diffs.json'))
+
+
+class DiffsWriter:
+    '''
+    Write alternative sets to a diffs file as they are produced.
+
+    The JSON format is the same as json.dump of the whole diff dict. The
+    JSON Lines format has the header (alignment_file, a_label, b_label) on
+    its first line and one alternative set on each following line, so
+    that it can be read back lazily (see evaluate_diffs.read_diffs). The
+    file is renamed into place when closed.
+    '''
+
+    def __init__(self, fname, header, jsonl=False):
+        self.fname = fname
+        self.jsonl = jsonl
+        self.num_alt_sets = 0
+        self.out = open(fname + '.part', 'w', encoding='utf-8')
+        if jsonl:
+            self.out.write(json.dumps(header) + '\n')
+        else:
+            self.out.write(json.dumps(header)[:-1] + ', "alt_sets": [')
 
-            eval_start = []
-            for prev_line in l_context:
-                eval_start.append(max(0, diff_start + len(prev_line)
-                                      - TARGET_CONTEXT))
+    def write(self, alt_sets):
+        for alt_set in alt_sets:
+            if self.jsonl:
+                self.out.write(json.dumps(alt_set) + '\n')
+            else:
+                if self.num_alt_sets:
+                    self.out.write(', ')
+                self.out.write(json.dumps(alt_set))
+            self.num_alt_sets += 1
+
+    def close(self):
+        if not self.jsonl:
+            self.out.write(']}')
+        self.out.close()
+        os.replace(self.fname + '.part', self.fname)
+
+    def discard(self):
+        '''Close and remove the partial file, leaving no diffs file.'''
+        self.out.close()
+        os.remove(self.fname + '.part')
+
+
+def load_pages(alignment, first=0, last=None, documents=None):
+    '''
+    page_lines output of the aligned pages first..last-1 of both versions.
+    documents is the pair of loaded documents, if already at hand.
+    '''
+    if documents is None:
+        documents = (load_document(alignment['a_file']),
+                     load_document(alignment['b_file']))
+    a_data, b_data = documents
+    if last is None:
+        last = len(alignment['pages'])
+    a_pages = [page_lines(a_data['pages'], p_num, verbose=False)
+               for p_num in range(first, min(last, len(a_data['pages'])))]
+    b_pages = [page_lines(b_data['pages'], p_num, verbose=False)
+               for p_num in range(first, min(last, len(b_data['pages'])))]
+    return a_pages, b_pages
+
+
+def num_line_pairs(alignment, first=0, last=None):
+    return sum(1 for page in alignment['pages'][first:last]
+               for k, v in page.items()
+               if k != 'null' and v is not None)
+
+
+# (alignment file, (alignment, documents)) last loaded by this process
+_loaded_alignment = (None, None)
+
+
+def load_alignment(alignment_fname):
+    '''
+    An alignment and both of its documents. Worker processes keep the last
+    ones loaded, so the chunks of an issue that a worker diffs one after
+    another share a single parse.
+    '''
+    global _loaded_alignment
+    if _loaded_alignment[0] != alignment_fname:
+        _loaded_alignment = (None, None)  # free the previous issue first
+        with open(alignment_fname) as alignment_file:
+            alignment = json.load(alignment_file)
+        documents = (load_document(alignment['a_file']),
+                     load_document(alignment['b_file']))
+        _loaded_alignment = (alignment_fname, (alignment, documents))
+    return _loaded_alignment[1]
+
+
+def diff_task(alignment_fname, first, last, backend):
+    '''
+    Diff pages first..last-1 of an alignment file in a worker process.
+    Returns the alternative sets with the worker's pid, the number of line
+    pairs processed and the time taken.
+    '''
+    start_t = time.time()
+    with instrument.stage('diff_task', alignment_file=alignment_fname,
+                          first=first, last=last):
+        with instrument.timed('load'):
+            alignment, documents = load_alignment(alignment_fname)
+            a_pages, b_pages = load_pages(alignment, first, last, documents)
+        alt_sets = []
+        for page_num, page, a_page, b_page in zip(
+                range(first, last), alignment['pages'][first:last],
+                a_pages, b_pages):
+            with instrument.page(page_num):
+                alt_sets.extend(diff_page(page, a_page, b_page, backend))
+    return (alt_sets, os.getpid(), num_line_pairs(alignment, first, last),
+            time.time() - start_t)
+
+
+def is_alignment(obj):
+    return isinstance(obj, dict) and all(
+        key in obj for key in ['a_file', 'b_file', 'pages'])
+
+
+def diff_directory(alignment_dir, backend='difflib', workers=None,
+                   pages_per_task=PAGES_PER_TASK, jsonl=False):
+    '''
+    Write the diff sets of every alignment file in a directory using a
+    process pool. Small alignments are a single task; larger ones are split
+    into chunks of pages_per_task pages, whose results are merged in page
+    order and written as soon as all preceding chunks are done.
+    Alignments that already have a diffs file are skipped, as are the
+    other JSON files of the directory (diffs, evaluations). A file that
+    fails is reported and leaves no diffs file behind; the others go on.
+    '''
+    tasks = {}
+    failed = []
+    for alignment_fname in sorted(glob(alignment_dir + '/*.json')):
+        if (alignment_fname.endswith(('_diffs.json', '_eval.json'))
+                or Path(diffs_fname(alignment_fname, jsonl)).exists()):
+            continue
+        try:
+            with open(alignment_fname) as alignment_file:
+                alignment = json.load(alignment_file)
+        except (OSError, ValueError) as e:
+            print(f'{alignment_fname} failed: {e!r}', file=stderr)
+            failed.append(alignment_fname)
+            continue
+        if not is_alignment(alignment):
+            continue
+        num_pages = len(alignment['pages'])
+        tasks[alignment_fname] = {
+            'header': {'alignment_file': alignment_fname,
+                       'a_label': alignment['a_label'],
+                       'b_label': alignment['b_label']},
+            'chunks': [(first, min(first + pages_per_task, num_pages))
+                       for first in range(0, max(num_pages, 1),
+                                          pages_per_task)],
+            'results': {},
+            'next_chunk': 0,
+            'writer': None}
+
+    worker_stats = defaultdict(lambda: [0, 0.0])
+    start_t = time.time()
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(diff_task, alignment_fname, first, last,
+                                   backend): (alignment_fname, ix)
+                   for alignment_fname, file_tasks in tasks.items()
+                   for ix, (first, last) in enumerate(file_tasks['chunks'])}
+        for future in as_completed(futures):
+            alignment_fname, ix = futures[future]
+            if alignment_fname not in tasks:  # an earlier chunk failed
+                continue
+            file_tasks = tasks[alignment_fname]
+            try:
+                alt_sets, pid, num_pairs, seconds = future.result()
+            except Exception as e:
+                print(f'{alignment_fname} failed: {e!r}', file=stderr)
+                failed.append(alignment_fname)
+                if file_tasks['writer'] is not None:
+                    file_tasks['writer'].discard()
+                del tasks[alignment_fname]
+                continue
+            worker_stats[pid][0] += num_pairs
+            worker_stats[pid][1] += seconds
+            file_tasks['results'][ix] = alt_sets
+            if file_tasks['writer'] is None:
+                file_tasks['writer'] = DiffsWriter(
+                    diffs_fname(alignment_fname, jsonl),
+                    file_tasks['header'], jsonl)
+            while file_tasks['next_chunk'] in file_tasks['results']:
+                file_tasks['writer'].write(
+                    file_tasks['results'].pop(file_tasks['next_chunk']))
+                file_tasks['next_chunk'] += 1
+            if file_tasks['next_chunk'] == len(file_tasks['chunks']):
+                file_tasks['writer'].close()
+                del tasks[alignment_fname]
+                print(diffs_fname(alignment_fname, jsonl))
+
+    total_pairs = sum(pairs for pairs, _ in worker_stats.values())
+    print(f"{total_pairs} line pairs in {time.time() - start_t:.1f} s",
+          file=stderr)
+    for pid, (pairs, seconds) in sorted(worker_stats.items()):
+        print(f"worker {pid}: {pairs} line pairs, "
+              f"{pairs / max(seconds, 1e-9):.0f} line pairs/s", file=stderr)
+    if failed:
+        print(f"{len(failed)} failed: {' '.join(failed)}", file=stderr)
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('alignment_file',
+                        help='Alignment JSON, or a directory of them')
+    parser.add_argument('--backend', choices=DIFF_BACKENDS,
+                        default='difflib',
+                        help='Character diff implementation')
+    parser.add_argument('--workers', '-j', type=int, default=os.cpu_count(),
+                        help='Worker processes for a directory')
+    parser.add_argument('--pages_per_task', type=int, default=PAGES_PER_TASK)
+    parser.add_argument('--jsonl', action='store_true',
+                        help='Write _diffs.jsonl, one alternative set per '
+                             'line, instead of _diffs.json')
+    instrument.add_arguments(parser)
+    return parser.parse_args()
 
-            # add next line for additional right context if necessary
-            r_missing = TARGET_CONTEXT + LR_CONTEXT - diff_end
 
-            if r_missing <= 0:
-                r_context = ['']
-            elif a_prev_text == b_prev_text and a_next_text == b_next_text:
-                r_context = [a_next_text]
-            else:
-                r_context = [a_next_text, b_next_text]
-            
-            # check whether a_text and b_text end in a hyphen
-
-            _, a_removed = remove_hyphen(a_text, r_context)
-            _, b_removed = remove_hyphen(b_text, r_context)
-
-            # generate alternatives
-
-            diff_dict['alt_sets'][-1]['context'] =\
-                ' // '.join([l_context[0],
-                             get_diff_string(segs),
-                             r_context[0]])
-
-            for text_variant, sources in zip(path_texts, path_sources):
-                for lc, rc, start in zip(l_context, r_context, eval_start):
-                    if a_removed >= 0 and sources[-1] == 'a':
-                        if a_removed:
-                            center = text_variant[:-a_removed]
-                        else:
-                            center = text_variant
-                        end = max(0, diff_end - TARGET_CONTEXT + len(rc)
-                                  - a_removed)
-                    elif b_removed >= 0 and sources[-1] == 'b':
-                        if b_removed:
-                            center = text_variant[:-b_removed]
-                        else:
-                            center = text_variant
-                        end = max(0, diff_end - TARGET_CONTEXT + len(rc)
-                                  - b_removed)
-                    else:
-                        center = text_variant + ' '
-                        end = max(0, diff_end - TARGET_CONTEXT + len(rc) + 1)
-                    concat_text = lc + center + rc
-                    conc_end = len(concat_text) - end
-                    # print('CENT', center)
-                    # print('LC:', lc)
-                    # print('RC:', rc)
-                    # print('CC:', concat_text)
-                    # eval_span = (concat_text[:start] + '##'
-                    #              + concat_text[start:conc_end] + '##'
-                    #              + concat_text[conc_end:])
-                    # print(eval_span)
-                    # print(f"{sources}, {start}, {conc_end}")
-
-                    diff_dict['alt_sets'][-1]['alternatives'].append(
-                        {'text': concat_text, 'sources': sources,
-                         'start': start, 'end': conc_end})
-
-    diff_fname = argv[1][:-len('.json')] + '_diffs.json'
-    with open(diff_fname, 'w', encoding='utf-8') as diff_file:
-        json.dump(diff_dict, diff_file)
+def main():
+    args = argparser()
+    instrument.setup(args, 'diff_lines')
+    if Path(args.alignment_file).is_dir():
+        diff_directory(args.alignment_file, args.backend, args.workers,
+                       args.pages_per_task, args.jsonl)
+        return
+
+    print(args.alignment_file)
+    with instrument.stage('diff_file', alignment_file=args.alignment_file):
+        with open(args.alignment_file) as alignment_file:
+            alignment = json.load(alignment_file)
+
+        with instrument.timed('load'):
+            a_data = load_document(alignment['a_file'])
+            b_data = load_document(alignment['b_file'])
+
+        writer = DiffsWriter(diffs_fname(args.alignment_file, args.jsonl),
+                             {'alignment_file': args.alignment_file,
+                              'a_label': alignment['a_label'],
+                              'b_label': alignment['b_label']},
+                             args.jsonl)
+        for page_num, page in enumerate(alignment['pages']):
+            with instrument.page(page_num):
+                with instrument.timed('page_lines'):
+                    a_page = page_lines(a_data['pages'], page_num,
+                                        verbose=False)
+                    b_page = page_lines(b_data['pages'], page_num,
+                                        verbose=False)
+                writer.write(diff_page(page, a_page, b_page, args.backend))
+        writer.close()
 
 if __name__ == '__main__':
     main()
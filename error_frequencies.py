@@ -0,0 +1,247 @@
+'''
+Directed and undirected OCR error frequency lists from evaluate_diffs
+output.
+
+Every difference of an alt set is an error: the text of the side that did
+not win was misread instead of the text of the winner. The lists are built
+in three steps, each of which can be rerun as new _eval.json files appear:
+
+    # count the errors of every _eval.json file not counted yet
+    python error_frequencies.py shards evals/ -s shards/ -j 8
+    # merge shards, e.g. ones counted on other machines, into one shard
+    python error_frequencies.py merge shards/ other/*.counts -o all.counts
+    # write the published lists
+    python error_frequencies.py write all.counts -o results/
+
+A shard is a JSON Lines file of [wrong, winner, count] sorted by (wrong,
+winner), so shards are merged as sorted streams, at most FAN_IN files at a
+time. The lists are sorted with an external merge sort, so memory is
+bounded by RUN_SIZE records however large the corpus is.
+
+The published format is frequency TAB one TAB another, with ∅ for the
+empty string and ␣ for space. The directed list has the wrong text first,
+the undirected list has the two texts in sorted order.
+'''
+import argparse
+import heapq
+import json
+import os
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+from pathlib import Path
+
+EVAL_SUFFIX = '_eval.json'
+SHARD_SUFFIX = '.counts'
+DIRECTED_FNAME = 'direc_full.tsv'
+UNDIRECTED_FNAME = 'undir_full.tsv'
+# records sorted in memory at a time
+RUN_SIZE = 1_000_000
+# files merged at a time, well below the usual limit of open files
+FAN_IN = 256
+EMPTY = '∅'
+SPACE = '␣'
+
+
+def error_counts(eval_fname):
+    '''Counter of the (wrong, winner) pairs of an _eval.json file.'''
+    with open(eval_fname) as eval_file:
+        out_dict = json.load(eval_file)
+    counts = Counter()
+    for alt_set in out_dict['alt_sets']:
+        for diff, winner in zip(alt_set['diffs'], alt_set['winners']):
+            wrong = 'b' if winner == 'a' else 'a'
+            counts[diff[wrong], diff[winner]] += 1
+    return counts
+
+
+def write_shard(records, fname):
+    '''Write sorted [one, another, count] records, renamed into place.'''
+    with open(fname + '.part', 'w', encoding='utf-8') as out:
+        for record in records:
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+    os.replace(fname + '.part', fname)
+
+
+def read_shard(fname):
+    with open(fname, encoding='utf-8') as shard:
+        for line in shard:
+            yield tuple(json.loads(line))
+
+
+def shard_fname(eval_fname, shard_dir):
+    return str(Path(shard_dir) /
+               (Path(eval_fname).name.removesuffix('.json') + SHARD_SUFFIX))
+
+
+def count_file(eval_fname, shard_dir):
+    counts = error_counts(eval_fname)
+    write_shard(sorted((one, another, count)
+                       for (one, another), count in counts.items()),
+                shard_fname(eval_fname, shard_dir))
+    return sum(counts.values())
+
+
+def sum_counts(records):
+    '''Sum the counts of consecutive records of the same pair.'''
+    for pair, group in groupby(records, key=lambda record: record[:2]):
+        yield (*pair, sum(record[2] for record in group))
+
+
+def merge_files(fnames, tmp_dir, key=None, fan_in=FAN_IN):
+    '''
+    Stream of the records of several sorted shards or runs, merged. At most
+    fan_in files are open at a time: more are first merged fan_in at a
+    time into intermediate runs in tmp_dir.
+    '''
+    fnames = list(fnames)
+    while len(fnames) > fan_in:
+        fnames = [write_run(heapq.merge(*(read_shard(fname) for fname in
+                                          fnames[ix:ix + fan_in]), key=key),
+                            tmp_dir)
+                  for ix in range(0, len(fnames), fan_in)]
+    return heapq.merge(*(read_shard(fname) for fname in fnames), key=key)
+
+
+def merge_shards(fnames, tmp_dir):
+    '''Stream of the summed records of several shards, sorted by pair.'''
+    return sum_counts(merge_files(fnames, tmp_dir))
+
+
+def external_sort(records, key, tmp_dir, run_size=RUN_SIZE):
+    '''
+    Sort records of any number by writing sorted runs of run_size records
+    to tmp_dir and merging them.
+    '''
+    runs = []
+    run = []
+    for record in records:
+        run.append(record)
+        if len(run) == run_size:
+            runs.append(write_run(sorted(run, key=key), tmp_dir))
+            run = []
+    if not runs:
+        yield from sorted(run, key=key)
+        return
+    runs.append(write_run(sorted(run, key=key), tmp_dir))
+    yield from merge_files(runs, tmp_dir, key=key)
+
+
+def write_run(records, tmp_dir):
+    fd, fname = tempfile.mkstemp(suffix=SHARD_SUFFIX, dir=tmp_dir)
+    os.close(fd)
+    write_shard(records, fname)
+    return fname
+
+
+def undirected(records, tmp_dir):
+    '''Undirected records, sorted by pair, of directed records.'''
+    return sum_counts(external_sort(
+        ((*sorted((one, another)), count) for one, another, count in records),
+        key=lambda record: record[:2], tmp_dir=tmp_dir))
+
+
+def by_frequency(records, tmp_dir):
+    return external_sort(records, tmp_dir=tmp_dir,
+                         key=lambda record: (-record[2], record[0], record[1]))
+
+
+def published(text):
+    return text.replace(' ', SPACE) if text else EMPTY
+
+
+def write_list(records, fname):
+    '''Write records in the published format.'''
+    with open(fname + '.part', 'w', encoding='utf-8') as out:
+        for one, another, count in records:
+            print(count, published(one), published(another), sep='\t',
+                  file=out)
+    os.replace(fname + '.part', fname)
+
+
+def list_shards(paths):
+    '''Shard files given directly or found in directories.'''
+    for path in paths:
+        if Path(path).is_dir():
+            yield from sorted(str(fname) for fname in
+                              Path(path).glob('*' + SHARD_SUFFIX))
+        else:
+            yield path
+
+
+def cmd_shards(args):
+    Path(args.shard_dir).mkdir(parents=True, exist_ok=True)
+    eval_fnames = [str(fname) for eval_dir in args.eval_dirs
+                   for fname in sorted(Path(eval_dir).glob('*' + EVAL_SUFFIX))]
+    todo = [fname for fname in eval_fnames
+            if not Path(shard_fname(fname, args.shard_dir)).exists()]
+    print(f'{len(todo)} files to count, '
+          f'{len(eval_fnames) - len(todo)} already counted')
+    start_t = time.time()
+    num_errors = 0
+    with ProcessPoolExecutor(args.workers) as executor:
+        futures = {executor.submit(count_file, fname, args.shard_dir): fname
+                   for fname in todo}
+        for future in as_completed(futures):
+            num_errors += future.result()
+    print(num_errors, 'errors', 'Time', time.time() - start_t)
+
+
+def cmd_merge(args):
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        write_shard(merge_shards(list_shards(args.shards), tmp_dir),
+                    args.output)
+
+
+def cmd_write(args):
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        # both lists are made from the shards merged once
+        merged = write_run(merge_shards(list_shards(args.shards), tmp_dir),
+                           tmp_dir)
+        write_list(by_frequency(read_shard(merged), tmp_dir),
+                   str(Path(args.output_dir) / DIRECTED_FNAME))
+        write_list(by_frequency(undirected(read_shard(merged), tmp_dir),
+                                tmp_dir),
+                   str(Path(args.output_dir) / UNDIRECTED_FNAME))
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    shards = subparsers.add_parser(
+        'shards', help='Count the errors of new _eval.json files')
+    shards.add_argument('eval_dirs', nargs='+')
+    shards.add_argument('--shard_dir', '-s', type=str, default='shards')
+    shards.add_argument('--workers', '-j', type=int, default=os.cpu_count())
+    shards.set_defaults(func=cmd_shards)
+
+    merge = subparsers.add_parser('merge', help='Merge shards into one')
+    merge.add_argument('shards', nargs='+',
+                       help='Shard files or directories of shards')
+    merge.add_argument('--output', '-o', type=str, required=True)
+    merge.add_argument('--tmp_dir', type=str, default=None,
+                       help='Directory of the intermediate merges')
+    merge.set_defaults(func=cmd_merge)
+
+    write = subparsers.add_parser(
+        'write', help='Write the directed and undirected lists')
+    write.add_argument('shards', nargs='+',
+                       help='Shard files or directories of shards')
+    write.add_argument('--output_dir', '-o', type=str, default='results')
+    write.add_argument('--tmp_dir', type=str, default=None,
+                       help='Directory of the sorted runs and merges')
+    write.set_defaults(func=cmd_write)
+    return parser.parse_args()
+
+
+def main():
+    args = argparser()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
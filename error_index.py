@@ -0,0 +1,181 @@
+'''
+Indexed queries over the error frequency lists written by
+error_frequencies.py (or the published undir_full.zip and direc_full.zip).
+
+The list is read once into a SQLite index, after that queries only touch
+the rows they return:
+
+    python error_index.py build results/direc_full.zip -o direc.sqlite
+    python error_index.py get direc.sqlite ő ó
+    python error_index.py top direc.sqlite l -k 10
+    python error_index.py prefix direc.sqlite 'rn' -k 20
+
+Texts are given and printed with the conventions of the lists: ∅ for the
+empty string and ␣ for space (a space given on the command line is
+converted). Output lines have the format of the lists. In an undirected
+index, get ignores the order of the two texts, and top and prefix match
+texts on either side of a pair.
+'''
+import argparse
+import io
+import sqlite3
+import zipfile
+from pathlib import Path
+
+from error_frequencies import SPACE, published
+
+# rows inserted per statement while building
+BATCH_SIZE = 100_000
+# larger than any character, for prefix ranges
+MAX_CHAR = '\U0010ffff'
+
+
+def read_list(fname):
+    '''(freq, one, another) rows of a TSV list, or of the list in a zip.'''
+    if zipfile.is_zipfile(fname):
+        with zipfile.ZipFile(fname) as zip_file:
+            member, = [name for name in zip_file.namelist()
+                       if not name.endswith('/')]
+            with zip_file.open(member) as binary:
+                yield from read_rows(io.TextIOWrapper(binary,
+                                                      encoding='utf-8'))
+    else:
+        with open(fname, encoding='utf-8') as list_file:
+            yield from read_rows(list_file)
+
+
+def read_rows(lines):
+    for line in lines:
+        freq, one, another = line.rstrip('\n').split('\t')
+        yield int(freq), one, another
+
+
+def build(list_fname, index_fname, directed):
+    if Path(index_fname).exists():
+        Path(index_fname).unlink()
+    conn = sqlite3.connect(index_fname)
+    conn.execute('CREATE TABLE meta (directed INTEGER NOT NULL)')
+    conn.execute('INSERT INTO meta VALUES (?)', (int(directed),))
+    conn.execute('CREATE TABLE errors (one TEXT NOT NULL, '
+                 'another TEXT NOT NULL, freq INTEGER NOT NULL, '
+                 'PRIMARY KEY (one, another)) WITHOUT ROWID')
+    rows = read_list(list_fname)
+    while True:
+        batch = [(one, another, freq)
+                 for _, (freq, one, another) in zip(range(BATCH_SIZE), rows)]
+        if not batch:
+            break
+        conn.executemany('INSERT INTO errors VALUES (?, ?, ?)', batch)
+    conn.execute('CREATE INDEX one_freq_idx ON errors (one, freq DESC)')
+    if not directed:
+        conn.execute('CREATE INDEX another_idx ON errors (another, one)')
+        conn.execute('CREATE INDEX another_freq_idx '
+                     'ON errors (another, freq DESC)')
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+
+
+class ErrorIndex:
+    '''Queries of an index built by build. Texts are in list format.'''
+
+    def __init__(self, index_fname):
+        self.conn = sqlite3.connect(f'file:{index_fname}?mode=ro', uri=True)
+        self.directed = bool(
+            self.conn.execute('SELECT directed FROM meta').fetchone()[0])
+
+    def get(self, one, another):
+        '''Frequency of a pair, 0 if it is not in the list.'''
+        pairs = [(one, another)]
+        if not self.directed:
+            # the pairs are ordered by their texts before ∅ and ␣ are
+            # substituted
+            pairs.append((another, one))
+        for pair in pairs:
+            row = self.conn.execute(
+                'SELECT freq FROM errors WHERE one = ? AND another = ?',
+                pair).fetchone()
+            if row:
+                return row[0]
+        return 0
+
+    def top(self, text, k=10):
+        '''The k most frequent pairs of text, as (freq, one, another).'''
+        return self.query('= ?', (text,), k)
+
+    def prefix(self, prefix, k=None):
+        '''The k (default: all) most frequent pairs of texts with prefix.'''
+        return self.query('>= ? AND {} < ?', (prefix, prefix + MAX_CHAR), k)
+
+    def query(self, condition, params, k=None):
+        limit = '' if k is None else f' LIMIT {int(k)}'
+        sides = ['one'] if self.directed else ['one', 'another']
+        selects = [f'SELECT freq, one, another FROM errors WHERE {side} '
+                   + condition.format(side) for side in sides]
+        # in an undirected index, pairs of a text with itself are not
+        # duplicated by the union
+        sql = ' UNION '.join(selects) + ' ORDER BY freq DESC, one, another'
+        return self.conn.execute(sql + limit,
+                                 params * len(sides)).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+def print_rows(rows):
+    for freq, one, another in rows:
+        print(freq, one, another, sep='\t')
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Index a list')
+    build_parser.add_argument('list', help='TSV list or zip of it')
+    build_parser.add_argument('--output', '-o', type=str, required=True)
+    build_parser.add_argument('--undirected', action='store_true',
+                              default=None,
+                              help='default: if the file name has undir')
+    build_parser.add_argument('--directed', dest='undirected',
+                              action='store_false')
+
+    get_parser = subparsers.add_parser('get', help='Frequency of a pair')
+    get_parser.add_argument('index')
+    get_parser.add_argument('one')
+    get_parser.add_argument('another')
+
+    top_parser = subparsers.add_parser('top', help='Top pairs of a text')
+    top_parser.add_argument('index')
+    top_parser.add_argument('text')
+    top_parser.add_argument('-k', type=int, default=10)
+
+    prefix_parser = subparsers.add_parser(
+        'prefix', help='Top pairs of texts with a prefix')
+    prefix_parser.add_argument('index')
+    prefix_parser.add_argument('prefix')
+    prefix_parser.add_argument('-k', type=int, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = argparser()
+    if args.command == 'build':
+        if args.undirected is None:
+            args.undirected = 'undir' in Path(args.list).name
+        build(args.list, args.output, directed=not args.undirected)
+        return
+
+    index = ErrorIndex(args.index)
+    if args.command == 'get':
+        print(index.get(published(args.one), published(args.another)))
+    elif args.command == 'top':
+        print_rows(index.top(published(args.text), args.k))
+    else:
+        # an empty prefix matches everything
+        print_rows(index.prefix(args.prefix.replace(' ', SPACE), args.k))
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,100 @@
+import io
 import json
 import os
+import argparse
+from itertools import chain, islice
 from pathlib import Path
-from sys import path, argv
+import numpy as np
 from more_itertools import split_into
 
-CLM_PATH = '/storage/sata2tbssd/character_language_models/'
-path.append(CLM_PATH)
-
-import lstm_model
-from encode_characters import InputEncoder, OutputEncoder
+import instrument
+from perplexity_cache import PerplexityCache, file_hash
+from scoring_service import (CLM_PATH, MAX_TOKENS, ScoringClient, StubModel,
+                             TokenBudgetModel, load_model, model_fname)
 
+# larger documents are evaluated in chunks
 MAX_DIFFS_PER_DOC = 70000
+CHECKPOINT_SUFFIX = '.checkpoint'
+DIFFS_SUFFIXES = ('_diffs.json', '_diffs.jsonl')
 
-input_enc = InputEncoder(file=CLM_PATH+"input_encoder.json")
-output_enc = OutputEncoder(file=CLM_PATH+"output_encoder.json")
-
-bilstm_model = lstm_model.BiLSTM_Model.load(
-    CLM_PATH + 'bilstm_model_512.h5', input_enc, output_enc)
 
-diff_dir = argv[1]
-diff_files = os.listdir(diff_dir)
+def read_diffs(fname):
+    '''
+    Open a diffs file written by diff_lines. Returns the header (alignment
+    file and labels) and an iterator over the alternative sets, which reads
+    _diffs.jsonl files lazily, one alternative set at a time.
+    '''
+    if fname.endswith('.jsonl'):
+        json_file = open(fname, encoding='utf-8')
+        header = json.loads(json_file.readline())
 
-for diff_fname in diff_files:
-    print(diff_fname)
-    if not diff_fname.endswith('_diffs.json'):
-        continue
+        def alt_sets():
+            with json_file:
+                for line in json_file:
+                    yield json.loads(line)
 
-    eval_fname = (diff_dir + '/' + diff_fname.removesuffix('.json')
-                  + '_eval.json')
-    if Path(eval_fname).exists():
-        continue
+        return header, alt_sets()
 
-    with open(diff_dir + '/' + diff_fname) as json_file:
+    with open(fname) as json_file:
         diff_dict = json.load(json_file)
+    alt_sets = diff_dict.pop('alt_sets')
+    return diff_dict, iter(alt_sets)
+
+
+def unique_sequences(sequences, start_indices, end_indices):
+    '''
+    Deduplicate (text, start, end) triples before scoring. Returns the
+    unique sequences, start and end indices, and for every input the
+    position of its triple among the unique ones.
+    '''
+    positions = []
+    unique = {}
+    for triple in zip(sequences, start_indices, end_indices):
+        positions.append(unique.setdefault(triple, len(unique)))
+    u_sequences = [triple[0] for triple in unique]
+    u_starts = [triple[1] for triple in unique]
+    u_ends = [triple[2] for triple in unique]
+    return u_sequences, u_starts, u_ends, positions
 
-    a_label = diff_dict['a_label']
-    b_label = diff_dict['b_label']
 
+def predict_perplexities(model, sequences, start_indices, end_indices,
+                         cache=None):
+    '''
+    Perplexities of the sequences, scored by the model (a loaded language
+    model or a ScoringClient). If a cache is given, only the sequences
+    missing from it are scored by the model, and their scores are added.
+    '''
+    if cache is None:
+        perplexities = [None] * len(sequences)
+    else:
+        perplexities = cache.get(sequences, start_indices, end_indices)
+    missing = [ix for ix, perpl in enumerate(perplexities) if perpl is None]
+    if not missing:
+        return perplexities
+
+    preds = model.predict_subsequences(
+        [sequences[ix] for ix in missing], start_indices=None,
+        end_indices=None, token_dicts=False, batch_size=12000)
+
+#    print(len(preds))
+    assert len(preds) == len(missing)
+
+    for ix, pred in zip(missing, preds):
+        perplexities[ix] = float(pred['substr-perpl'])
+    if cache is not None:
+        cache.put([sequences[ix] for ix in missing],
+                  [start_indices[ix] for ix in missing],
+                  [end_indices[ix] for ix in missing],
+                  [perplexities[ix] for ix in missing])
+    return perplexities
+
+
+def eval_fname_of(diff_dir, diff_fname):
+    return diff_dir + '/' + diff_fname.rsplit('.', 1)[0] + '_eval.json'
+
+
+def eval_input(header, alt_sets):
+    '''Collect the alternatives of alt sets into lists for scoring.'''
     diffs = []
     a_texts = []
     b_texts = []
@@ -49,7 +107,7 @@ for diff_fname in diff_files:
     start_indices = []
     end_indices = []
 
-    for alt_set in diff_dict['alt_sets']:
+    for alt_set in alt_sets:
         split_counts.append(len(alt_set['alternatives']))
         diffs.append(alt_set['diffs'])
         a_texts.append(alt_set['a_text'])
@@ -64,70 +122,327 @@ for diff_fname in diff_files:
     assert len(sequences) == len(sources)
     assert len(sequences) == len(start_indices)
     assert len(sequences) == len(end_indices)
-    print(len(sequences))
 
-    if len(sequences) == 0 or len(sequences) > MAX_DIFFS_PER_DOC:
-        print("Skipping")
-        continue
+    return {'a_label': header['a_label'], 'b_label': header['b_label'],
+            'diffs': diffs, 'a_texts': a_texts, 'b_texts': b_texts,
+            'contexts': contexts, 'sequences': sequences,
+            'sources': sources, 'split_counts': split_counts,
+            'start_indices': start_indices, 'end_indices': end_indices}
 
-    preds = bilstm_model.predict_subsequences(
-        sequences, start_indices=None, end_indices=None,
-        token_dicts=False, batch_size=12000)
 
-#    print(len(preds))
-    assert len(preds) == len(sequences)
-
-    perplexities = [pred['substr-perpl'] for pred in preds]
-
-    # for perpl, text, start, end in zip(perplexities, sequences,
-    #                                    start_indices, end_indices):
-    #     print(perpl, text[start:end])
-
-    split_preds = split_into(perplexities, split_counts)
-    split_sources = split_into(sources, split_counts)
-    split_seqs = split_into(sequences, split_counts)
-
-    outfile = open(eval_fname.removesuffix(".json") + ".tsv",
-                   'w', encoding='utf-8')
-    out_dict = {'diff_file': diff_fname, "a_label": a_label,
-                "b_label": b_label, "alt_sets": []}
-
-    for (line_context, a_txt, b_txt, line_diffs,
-         line_prs, line_srcs, line_seqs) in zip(
-            contexts, a_texts, b_texts, diffs,
-            split_preds, split_sources, split_seqs):
-        best_pred = min(line_prs)
-        out_dict['alt_sets'].append({'diffs': line_diffs, 'winners': [],
-                                    'min_perplexities': []})
+def eval_chunks(diff_dir, diff_fname, chunk_size=MAX_DIFFS_PER_DOC, skip=0):
+    '''
+    Read a diffs file in chunks of whole alt sets, each closed when it has
+    at least chunk_size sequences. The first skip alt sets are left out.
+    '''
+    header, alt_sets = read_diffs(diff_dir + '/' + diff_fname)
+    chunk = []
+    num_sequences = 0
+    for alt_set in islice(alt_sets, skip, None):
+        chunk.append(alt_set)
+        num_sequences += len(alt_set['alternatives'])
+        if num_sequences >= chunk_size:
+            yield eval_input(header, chunk)
+            chunk = []
+            num_sequences = 0
+    if chunk:
+        yield eval_input(header, chunk)
+
+
+def score_documents(docs, model, cache=None):
+    '''
+    Perplexities of the alternatives of several documents, pooled so that
+    the batches of the model are filled. Returns a list per document.
+    '''
+    sequences, start_indices, end_indices = [], [], []
+    for doc in docs:
+        sequences.extend(doc['sequences'])
+        start_indices.extend(doc['start_indices'])
+        end_indices.extend(doc['end_indices'])
+
+    u_sequences, u_starts, u_ends, positions = unique_sequences(
+        sequences, start_indices, end_indices)
+    instrument.count('sequences', len(sequences))
+    instrument.count('unique_sequences', len(u_sequences))
+    print(f"{len(docs)} documents, {len(sequences)} sequences, "
+          f"{len(u_sequences)} unique "
+          f"(dedup ratio {1 - len(u_sequences) / len(sequences):.2%})")
+    for doc in docs:
+        num_unique = len(set(zip(doc['sequences'], doc['start_indices'],
+                                 doc['end_indices'])))
+        print(f"  {doc.get('diff_fname', 'chunk')}: "
+              f"{len(doc['sequences'])} sequences, {num_unique} unique "
+              f"({num_unique / max(len(doc['sequences']), 1):.2%} of total)")
+
+    with instrument.timed('score'):
+        u_perplexities = predict_perplexities(model, u_sequences, u_starts,
+                                              u_ends, cache)
+    if cache is not None:
+        print("Cache", cache.stats())
+
+    # scatter the perplexities of the unique sequences back
+    perplexities = [u_perplexities[pos] for pos in positions]
+    return list(split_into(perplexities,
+                           [len(doc['sequences']) for doc in docs]))
+
+
+def select_winners(perplexities, sources, split_counts, num_diffs):
+    '''
+    Minimum perplexity of the alternatives with the a and with the b side
+    of every difference, for all alt sets of a document at once.
+
+    The sources are encoded as a (variant x diff position) matrix, and the
+    minima are masked reductions over the variants of each alt set.
+    Returns the (alt set x diff position) arrays min_a and min_b, and the
+    index of the first variant whose sources are the winners of its alt
+    set (-1 if there is none).
+    '''
+    lengths = np.array([len(source) for source in sources])
+    width = max(lengths.max(initial=0), 1)
+    chars = np.array([source.ljust(width) for source in sources],
+                     dtype=f'<U{width}').view('<U1') \
+        .reshape(len(sources), width)
+    is_a = chars == 'a'
+    is_b = chars == 'b'
+    perpls = np.array(perplexities, dtype=np.float64)[:, None]
+    offsets = np.cumsum([0] + split_counts[:-1])
+
+    min_a = np.minimum.reduceat(np.where(is_a, perpls, np.inf), offsets)
+    min_b = np.minimum.reduceat(np.where(is_b, perpls, np.inf), offsets)
+
+    # a variant matches if it has the winning side at every diff position
+    alt_set_ix = np.repeat(np.arange(len(split_counts)), split_counts)
+    a_wins = (min_a < min_b)[alt_set_ix]
+    matches = (((is_a == a_wins) & (is_a | is_b)) | (chars == ' ')) \
+        .all(axis=1) & (lengths == np.array(num_diffs)[alt_set_ix])
+    variant_ix = np.arange(len(sources))
+    first = np.minimum.reduceat(np.where(matches, variant_ix, len(sources)),
+                                offsets)
+    first[first == len(sources)] = -1
+    return min_a, min_b, first
+
+
+def evaluate_alt_sets(doc, perplexities, outfile):
+    '''
+    Pick the winner of every difference by the perplexities of the
+    alternatives. Prints the report of each alt set to outfile, and returns
+    the alt sets of the _eval.json output.
+    '''
+    min_a, min_b, first = select_winners(
+        perplexities, doc['sources'], doc['split_counts'],
+        [len(line_diffs) for line_diffs in doc['diffs']])
+    winners = np.where(min_a < min_b, 'a', 'b').tolist()
+    min_a = min_a.tolist()
+    min_b = min_b.tolist()
+    first = first.tolist()
+
+    out_alt_sets = []
+    for (set_ix, line_context, a_txt, b_txt, line_diffs) in zip(
+            range(len(doc['diffs'])), doc['contexts'], doc['a_texts'],
+            doc['b_texts'], doc['diffs']):
+        num_diffs = len(line_diffs)
+        min_perplexities = [
+            {'a': f'{a:.4f}', 'b': f'{b:.4f}'}
+            for a, b in zip(min_a[set_ix][:num_diffs],
+                            min_b[set_ix][:num_diffs])]
+        out_alt_sets.append({'diffs': line_diffs,
+                             'winners': winners[set_ix][:num_diffs],
+                             'min_perplexities': min_perplexities})
         print('', file=outfile)
         print(line_context, file=outfile)
-        for ix, diff in enumerate(line_diffs):
-            a_preds = [p for p, s in zip(line_prs, line_srcs) if s[ix] == 'a']
-            b_preds = [p for p, s in zip(line_prs, line_srcs) if s[ix] == 'b']
-            min_a = min(a_preds)
-            min_b = min(b_preds)
-            if min_a < min_b:
-                winner = 'a'
-            else:
-                winner = 'b'
-            out_dict['alt_sets'][-1]['winners'].append(winner)
-            out_dict['alt_sets'][-1]['min_perplexities'].append(
-                {'a': f'{min_a:.4f}', 'b': f'{min_b:.4f}'})
-
+        for diff, winner, min_perpls in zip(line_diffs, winners[set_ix],
+                                            min_perplexities):
             print('\t'.join([f"›{diff['a']}‹", f"›{diff['b']}‹",
-                             f'›{diff[winner]}‹',
-                             f'{min_a:.4f}', f'{min_b:.4f}']),
+                              f'›{diff[winner]}‹',
+                              min_perpls['a'], min_perpls['b']]),
                   file=outfile)
-        assert len(out_dict['alt_sets'][-1]['diffs']) ==\
-            len(out_dict['alt_sets'][-1]['winners'])
         print("A:", a_txt, file=outfile)
         print("B:", b_txt, file=outfile)
-        winners = ''.join(out_dict['alt_sets'][-1]['winners'])
-        for alt_text, source in zip(line_seqs, line_srcs):
-            if source == winners:
-                print("->", alt_text, file=outfile)
-                break
+        if first[set_ix] >= 0:
+            print("->", doc['sequences'][first[set_ix]], file=outfile)
+    return out_alt_sets
+
+
+def tsv_fname_of(eval_fname):
+    return eval_fname.removesuffix(".json") + ".tsv"
+
+
+def write_eval(doc, perplexities):
+    '''Write DIFFS_eval.json and DIFFS_eval.tsv of a whole document.'''
+    outfile = open(tsv_fname_of(doc['eval_fname']), 'w', encoding='utf-8')
+    out_dict = {'diff_file': doc['diff_fname'], "a_label": doc['a_label'],
+                "b_label": doc['b_label'],
+                "alt_sets": evaluate_alt_sets(doc, perplexities, outfile)}
     outfile.close()
 
-    with open(eval_fname, 'w') as out_json:
+    with open(doc['eval_fname'], 'w') as out_json:
         json.dump(out_dict, out_json)
+
+
+def read_checkpoint(eval_fname):
+    '''Progress of an interrupted chunked evaluation.'''
+    try:
+        with open(eval_fname + CHECKPOINT_SUFFIX) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except FileNotFoundError:
+        return {'alt_sets': 0, 'json_bytes': 0, 'tsv_bytes': 0}
+
+
+def evaluate_chunked(diff_fname, eval_fname, chunks, checkpoint, model,
+                     cache=None):
+    '''
+    Evaluate a large document chunk by chunk. The outputs of each chunk are
+    appended to partial files, and a checkpoint records how far they are
+    valid, so an interrupted run resumes after the last finished chunk.
+    The final outputs are the same as those of write_eval.
+    '''
+    json_part = eval_fname + '.part'
+    tsv_part = tsv_fname_of(eval_fname) + '.part'
+    if (checkpoint['tsv_bytes'] and not Path(tsv_part).exists()
+            and Path(tsv_fname_of(eval_fname)).exists()):
+        # interrupted while finishing
+        os.replace(tsv_fname_of(eval_fname), tsv_part)
+
+    with open(json_part, 'ab') as json_out, open(tsv_part, 'ab') as tsv_out:
+        # drop the output of an unfinished chunk
+        json_out.truncate(checkpoint['json_bytes'])
+        tsv_out.truncate(checkpoint['tsv_bytes'])
+        for chunk in chunks:
+            header = {'diff_file': diff_fname, 'a_label': chunk['a_label'],
+                      'b_label': chunk['b_label']}
+            print(f"Chunk at alt set {checkpoint['alt_sets']}:",
+                  len(chunk['sequences']))
+            with instrument.stage('chunk', diff_file=diff_fname,
+                                  alt_set=checkpoint['alt_sets']):
+                perplexities, = score_documents([chunk], model, cache)
+                report = io.StringIO()
+                alt_sets = evaluate_alt_sets(chunk, perplexities, report)
+            json_out.write(''.join(json.dumps(alt_set) + '\n'
+                                   for alt_set in alt_sets).encode('utf-8'))
+            tsv_out.write(report.getvalue().encode('utf-8'))
+            json_out.flush()
+            tsv_out.flush()
+            os.fsync(json_out.fileno())
+            os.fsync(tsv_out.fileno())
+            checkpoint = {'alt_sets': checkpoint['alt_sets'] + len(alt_sets),
+                          'json_bytes': json_out.tell(),
+                          'tsv_bytes': tsv_out.tell(),
+                          'header': header}
+            with open(eval_fname + CHECKPOINT_SUFFIX + '.tmp', 'w') as out:
+                json.dump(checkpoint, out)
+            os.replace(eval_fname + CHECKPOINT_SUFFIX + '.tmp',
+                       eval_fname + CHECKPOINT_SUFFIX)
+
+    # same as json.dump of the whole out_dict, written one alt set at a time
+    header = checkpoint['header']
+    with (open(json_part, encoding='utf-8') as json_in,
+          open(eval_fname + '.tmp', 'w') as out_json):
+        out_json.write(json.dumps(header)[:-1] + ', "alt_sets": [')
+        for ix, line in enumerate(json_in):
+            if ix:
+                out_json.write(', ')
+            out_json.write(line.rstrip('\n'))
+        out_json.write(']}')
+    os.replace(tsv_part, tsv_fname_of(eval_fname))
+    os.replace(eval_fname + '.tmp', eval_fname)
+    os.remove(json_part)
+    os.remove(eval_fname + CHECKPOINT_SUFFIX)
+
+
+def evaluate_pool(docs, model, cache=None):
+    with instrument.stage('evaluate_pool', num_files=len(docs)):
+        for doc, perplexities in zip(docs,
+                                     score_documents(docs, model, cache)):
+            with instrument.timed('write'):
+                write_eval(doc, perplexities)
+    print("Model", model.stats())
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('diff_dir')
+    parser.add_argument('--clm_path', type=str, default=CLM_PATH,
+                        help='Directory of the character language model')
+    parser.add_argument('--server', type=str, default=None,
+                        help='Unix socket of a running scoring_service.py '
+                             'to score with instead of loading the model')
+    parser.add_argument('--stub', action='store_true',
+                        help='Score with a deterministic stub model')
+    parser.add_argument('--max_tokens', type=int, default=MAX_TOKENS,
+                        help='Characters per model call, padding included')
+    parser.add_argument('--pool_size', type=int, default=MAX_DIFFS_PER_DOC,
+                        help='Sequences of several diffs files scored '
+                             'together')
+    parser.add_argument('--chunk_size', type=int, default=MAX_DIFFS_PER_DOC,
+                        help='Documents with more sequences are evaluated '
+                             'in resumable chunks of about this size')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='SQLite perplexity cache shared across runs '
+                             'and processes')
+    parser.add_argument('--cache_mb', type=int, default=4096,
+                        help='Size limit of the cache')
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = argparser()
+    instrument.setup(args, 'evaluate_diffs')
+    if args.server is not None:
+        model = ScoringClient(args.server)
+        model_id = model.model_id
+    elif args.stub:
+        model = StubModel()
+        model_id = StubModel.model_id
+    else:
+        model = load_model(args.clm_path)
+        model_id = None
+
+    cache = None
+    if args.cache is not None:
+        if model_id is None:
+            model_id = file_hash(model_fname(args.clm_path))
+        cache = PerplexityCache(args.cache, model_id, args.cache_mb)
+
+    model = TokenBudgetModel(model, args.max_tokens)
+
+    # documents are pooled until they have pool_size sequences
+    pool = []
+    for diff_fname in os.listdir(args.diff_dir):
+        print(diff_fname)
+        if not diff_fname.endswith(DIFFS_SUFFIXES):
+            continue
+        eval_fname = eval_fname_of(args.diff_dir, diff_fname)
+        if Path(eval_fname).exists():
+            continue
+
+        checkpoint = read_checkpoint(eval_fname)
+        chunks = eval_chunks(args.diff_dir, diff_fname, args.chunk_size,
+                             checkpoint['alt_sets'])
+        doc = next(chunks, None)
+        if checkpoint['alt_sets'] == 0:
+            if doc is None:
+                print("Skipping")
+                continue
+            more = next(chunks, None)
+            if more is None:
+                # small document: scored together with others
+                print(len(doc['sequences']))
+                doc.update(diff_fname=diff_fname, eval_fname=eval_fname)
+                pool.append(doc)
+                if (sum(len(doc['sequences']) for doc in pool)
+                        >= args.pool_size):
+                    evaluate_pool(pool, model, cache)
+                    pool = []
+                continue
+            chunks = chain([doc, more], chunks)
+        elif doc is not None:
+            chunks = chain([doc], chunks)
+        evaluate_chunked(diff_fname, eval_fname, chunks, checkpoint,
+                         model, cache)
+    if pool:
+        evaluate_pool(pool, model, cache)
+
+
+if __name__ == '__main__':
+    main()
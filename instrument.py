@@ -0,0 +1,164 @@
+'''
+Timings and counters of the pipeline stages, written as JSON Lines.
+
+pdf_extract, align_lines, diff_lines and evaluate_diffs take the options
+added by add_arguments:
+
+    python align/align_lines.py a.json b.json --stats stats.jsonl \
+        --profile_pages 10-12
+
+Each finished stage (a document, a page, a pool of diff files) is one
+record: the script, the pid, the stage name and its fields (and those of
+the stages it is nested in), its seconds, and the counters counted while it
+ran (lines per page, candidate pairs, Levenshtein calls, alternatives,
+model tokens, cache hits ...). The counters of a stage include those of
+the stages nested in it. Sub-steps timed with timed() are added to the
+counters as NAME_seconds.
+
+Pages in the --profile_pages range are run under cProfile (or pyinstrument,
+if installed and selected), and their profiles are saved to --profile_dir.
+
+When --stats is not given, count and timed do nothing, so the counters
+can stay in hot code. Worker processes inherit the settings through the
+environment, and append their records to the same file.
+'''
+import json
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+ENV_VAR = 'PIPELINE_INSTRUMENT'
+
+_settings = None
+_fd = None
+# (stage name, fields, counters) of the stages being run
+_stack = []
+
+
+def add_arguments(parser):
+    parser.add_argument('--stats', type=str, default=None,
+                        help='Append stage timings and counters to this '
+                             'JSON Lines file')
+    parser.add_argument('--profile_pages', type=str, default=None,
+                        metavar='FIRST-LAST',
+                        help='Profile the pages in this range (needs '
+                             '--stats)')
+    parser.add_argument('--profile_dir', type=str, default='profiles')
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'],
+                        default='cprofile')
+
+
+def setup(args, script):
+    '''Enable instrumentation as requested by the add_arguments options.'''
+    if args.stats is None:
+        return
+    pages = None
+    if args.profile_pages is not None:
+        first, _, last = args.profile_pages.partition('-')
+        pages = [int(first), int(last or first)]
+    enable({'stats': args.stats, 'script': script, 'profile_pages': pages,
+            'profile_dir': args.profile_dir, 'profiler': args.profiler})
+
+
+def enable(settings):
+    global _settings, _fd
+    _settings = settings
+    _fd = os.open(settings['stats'], os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    # for worker processes
+    os.environ[ENV_VAR] = json.dumps(settings)
+
+
+def enabled():
+    return _fd is not None
+
+
+def count(name, n=1):
+    '''Add n to a counter of the current stage.'''
+    if _stack:
+        _stack[-1][2][name] += n
+
+
+@contextmanager
+def timed(name):
+    '''Add the seconds of a sub-step to the counters of the current stage.'''
+    if not _stack:
+        yield
+        return
+    start_t = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stack[-1][2][name + '_seconds'] += time.perf_counter() - start_t
+
+
+@contextmanager
+def stage(name, **fields):
+    '''Run a stage and write its record when it is finished.'''
+    if _fd is None:
+        yield
+        return
+    counters = Counter()
+    _stack.append((name, fields, counters))
+    profiler = start_profiler(fields.get('page'))
+    start_t = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start_t
+        _stack.pop()
+        if profiler is not None:
+            stop_profiler(profiler, fields)
+        record = {'script': _settings['script'], 'pid': os.getpid(),
+                  'stage': name}
+        for _, outer_fields, _ in _stack:
+            record.update(outer_fields)
+        record.update(fields)
+        record['seconds'] = round(seconds, 6)
+        record['counts'] = {key: round(value, 6)
+                            if isinstance(value, float) else value
+                            for key, value in counters.items()}
+        os.write(_fd, (json.dumps(record, ensure_ascii=False) + '\n')
+                 .encode('utf-8'))
+        if _stack:
+            _stack[-1][2].update(counters)
+
+
+def page(p_num, **fields):
+    '''Stage of a single page; pages in the selected range are profiled.'''
+    return stage('page', page=p_num, **fields)
+
+
+def start_profiler(p_num):
+    pages = _settings['profile_pages']
+    if p_num is None or pages is None or not pages[0] <= p_num <= pages[1]:
+        return None
+    if _settings['profiler'] == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler, fields):
+    Path(_settings['profile_dir']).mkdir(parents=True, exist_ok=True)
+    label = '_'.join([_settings['script'], str(os.getpid())]
+                     + [f'{key}{value}' for key, value in fields.items()])
+    fname = str(Path(_settings['profile_dir'])
+                / label.replace('/', '_').replace(' ', '_'))
+    if _settings['profiler'] == 'pyinstrument':
+        profiler.stop()
+        with open(fname + '.txt', 'w', encoding='utf-8') as out:
+            out.write(profiler.output_text())
+    else:
+        profiler.disable()
+        profiler.dump_stats(fname + '.prof')
+
+
+if ENV_VAR in os.environ and _fd is None:
+    enable(json.loads(os.environ[ENV_VAR]))
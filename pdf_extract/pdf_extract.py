@@ -1,7 +1,17 @@
+import os
+import sys
 import json
-from sys import argv
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from sys import path, stderr, stdout
 import fitz
 
+# for the modules at the top of the repository
+path.append(str(Path(__file__).resolve().parents[1]))
+import instrument
+
 PDF_FLAGS = (fitz.TEXT_PRESERVE_WHITESPACE
              | fitz.TEXT_INHIBIT_SPACES
              | fitz.TEXT_MEDIABOX_CLIP)
@@ -53,23 +63,196 @@ def to_tuple(rect):
     return (rect.x0, rect.y0, rect.x1, rect.y1)
 
 
+# (path, document) last opened by this process
+_open_document = (None, None)
+
+
+def extract_pages(pdf_path, first, last):
+    '''
+    Restructure pages first..last-1 of a PDF and return them serialised.
+    Runs in worker processes, which keep their last document open.
+    '''
+    global _open_document
+    if _open_document[0] != pdf_path:
+        if _open_document[1] is not None:
+            _open_document[1].close()
+        _open_document = (pdf_path, fitz.open(pdf_path))
+    pdf_document = _open_document[1]
+    page_jsons = []
+    for p_num in range(first, last):
+        with instrument.page(p_num, pdf=pdf_path):
+            page = restructure_pdf(pdf_document[p_num])
+            instrument.count('blocks', len(page['blocks']))
+            instrument.count('lines', sum(len(block['lines'])
+                                          for block in page['blocks']))
+            page_jsons.append(json.dumps(page))
+    return page_jsons
+
+
+def page_tasks(pdf_paths, pages_per_task, failed):
+    '''
+    Split PDFs into page ranges. PDFs that cannot be opened are recorded in
+    failed, keyed by path, and skipped.
+    '''
+    for pdf_path in pdf_paths:
+        try:
+            with fitz.open(pdf_path) as pdf_document:
+                page_count = pdf_document.page_count
+        except Exception as e:
+            failed[pdf_path] = e
+            continue
+        if page_count == 0:
+            yield pdf_path, 0, 0
+        for first in range(0, page_count, pages_per_task):
+            yield pdf_path, first, min(first + pages_per_task, page_count)
+
+
+def extracted_pages(tasks, workers):
+    '''
+    Yield (pdf_path, first, last, page_jsons) for each task, in task order.
+    If a task fails, its exception is yielded in place of page_jsons.
+    With several workers, only a bounded number of tasks is in flight, so
+    memory does not grow with the number of pages.
+    '''
+    if workers <= 1:
+        for task in tasks:
+            try:
+                yield *task, extract_pages(*task)
+            except Exception as e:
+                yield *task, e
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        in_flight = deque()
+
+        def next_result():
+            task, future = in_flight.popleft()
+            try:
+                return *task, future.result()
+            except Exception as e:
+                return *task, e
+
+        for task in tasks:
+            in_flight.append((task, executor.submit(extract_pages, *task)))
+            if len(in_flight) >= 2 * workers:
+                yield next_result()
+        while in_flight:
+            yield next_result()
+
+
+class PagesWriter:
+    '''
+    Write pages to a JSON document as they arrive. The output is the same as
+    json.dump({'pages': pages}); it is written to a temporary file that is
+    only renamed to output_path when complete.
+    '''
+
+    def __init__(self, output_path=None):
+        self.output_path = output_path
+        if output_path is None:
+            self.out = stdout
+        else:
+            Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+            self.out = open(output_path + '.part', 'w')
+        self.out.write('{"pages": [')
+        self.num_pages = 0
+
+    def write(self, page_jsons):
+        for page_json in page_jsons:
+            if self.num_pages:
+                self.out.write(', ')
+            self.out.write(page_json)
+            self.num_pages += 1
+
+    def close(self):
+        self.out.write(']}')
+        if self.output_path is None:
+            self.out.write('\n')
+            self.out.flush()
+        else:
+            self.out.close()
+            os.replace(self.output_path + '.part', self.output_path)
+
+    def discard(self):
+        '''Abandon the document, removing its temporary file.'''
+        if self.output_path is None:
+            self.out.flush()
+        else:
+            self.out.close()
+            os.remove(self.output_path + '.part')
+
+
+def process_pdfs(pdf_paths, output_paths, workers=1, pages_per_task=8):
+    '''
+    Extract PDFs with a shared pool of workers, streaming each document
+    to its output path in page order. An output path of None means stdout.
+    A PDF that fails is reported and left without output; the others are
+    still extracted. Returns the paths of the failed PDFs.
+    '''
+    output_of = dict(zip(pdf_paths, output_paths))
+    failed = {}
+    writer = None
+    current_path = None
+    for pdf_path, first, last, page_jsons in extracted_pages(
+            page_tasks(pdf_paths, pages_per_task, failed), workers):
+        if pdf_path in failed:
+            continue
+        if isinstance(page_jsons, Exception):
+            failed[pdf_path] = page_jsons
+            if pdf_path == current_path:
+                writer.discard()
+                writer = None
+                current_path = None
+            continue
+        if pdf_path != current_path:
+            if writer is not None:
+                writer.close()
+            writer = PagesWriter(output_of[pdf_path])
+            current_path = pdf_path
+        writer.write(page_jsons)
+    if writer is not None:
+        writer.close()
+    for pdf_path, e in failed.items():
+        print(f'{pdf_path} failed: {e!r}', file=stderr)
+    return list(failed)
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pdf_path',
+                        help='PDF file, or a directory of PDFs')
+    parser.add_argument('output_path', nargs='?', default=None,
+                        help='JSON file (default: stdout), or the output '
+                             'directory if pdf_path is a directory')
+    parser.add_argument('--workers', '-j', type=int, default=1)
+    parser.add_argument('--pages_per_task', type=int, default=8)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    if Path(args.pdf_path).is_dir() and args.output_path is None:
+        parser.error('an output directory is needed for a directory of PDFs')
+    return args
+
+
 def process_pdf():
-    try:
-        pdf_path, output_path = argv[1], argv[2]
-    except IndexError:
-        pdf_path, output_path = argv[1], None
-    output_data = {'pages': []}
-    pdf_document = fitz.open(pdf_path)
-
-    for page in pdf_document:
-        output_data['pages'].append(
-            restructure_pdf(page))
-
-    if output_path is None:
-        print(json.dumps(output_data))
+    args = argparser()
+    instrument.setup(args, 'pdf_extract')
+    if Path(args.pdf_path).is_dir():
+        pdf_paths = []
+        output_paths = []
+        for pdf_file in sorted(Path(args.pdf_path).glob('**/*.pdf')):
+            output_path = str(Path(args.output_path)
+                              / pdf_file.relative_to(args.pdf_path)
+                                        .with_suffix('.json'))
+            # finished outputs are skipped, so an interrupted run can resume
+            if not Path(output_path).exists():
+                pdf_paths.append(str(pdf_file))
+                output_paths.append(output_path)
     else:
-        with open(output_path, 'w') as json_out:
-            json.dump(output_data, json_out)
+        pdf_paths = [args.pdf_path]
+        output_paths = [args.output_path]
+    failed = process_pdfs(pdf_paths, output_paths, args.workers,
+                          args.pages_per_task)
+    if failed:
+        sys.exit(f'{len(failed)} of {len(pdf_paths)} PDFs failed')
 
 
 def main():
@@ -0,0 +1,124 @@
+'''
+Persistent cache of language model perplexities for evaluate_diffs.
+
+Entries are keyed on a model id (the hash of the model file, see
+file_hash) and the scored (sequence, start, end) triple, so a retrained
+model never gets stale scores. The cache is a SQLite database in WAL
+mode: several evaluator processes can read and write it at the same time.
+When the database grows beyond max_mb, the least recently used entries
+are evicted.
+'''
+import hashlib
+import json
+import sqlite3
+import time
+
+import instrument
+
+# triples looked up or stored per SQL statement
+CHUNK_SIZE = 500
+# share of the entries evicted when the cache is full
+EVICT_RATIO = 0.1
+
+
+def file_hash(fname):
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as model_file:
+        for block in iter(lambda: model_file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class PerplexityCache:
+
+    def __init__(self, db_path, model_id, max_mb=4096):
+        self.model_id = model_id
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(db_path, timeout=600,
+                                    isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS perplexities ('
+                          'key BLOB PRIMARY KEY, '
+                          'perplexity REAL NOT NULL, '
+                          'last_used REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS last_used_idx '
+                          'ON perplexities (last_used)')
+
+    def key(self, sequence, start, end):
+        return hashlib.sha1(
+            (self.model_id + json.dumps([sequence, start, end]))
+            .encode('utf-8')).digest()
+
+    def get(self, sequences, start_indices, end_indices):
+        '''
+        Look up triples. Returns a list with the cached perplexity, or None
+        for misses, of every triple.
+        '''
+        keys = [self.key(*triple)
+                for triple in zip(sequences, start_indices, end_indices)]
+        found = {}
+        for ix in range(0, len(keys), CHUNK_SIZE):
+            chunk = keys[ix:ix + CHUNK_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.conn.execute(
+                'SELECT key, perplexity FROM perplexities '
+                f'WHERE key IN ({placeholders})', chunk).fetchall()
+            found.update(rows)
+            if rows:
+                self.conn.execute(
+                    'UPDATE perplexities SET last_used = ? '
+                    f'WHERE key IN ({placeholders})', [time.time(), *chunk])
+        perplexities = [found.get(key) for key in keys]
+        num_hits = sum(1 for p in perplexities if p is not None)
+        self.hits += num_hits
+        self.misses += len(keys) - num_hits
+        instrument.count('cache_hits', num_hits)
+        instrument.count('cache_misses', len(keys) - num_hits)
+        return perplexities
+
+    def put(self, sequences, start_indices, end_indices, perplexities):
+        now = time.time()
+        # numpy scalars would be stored as BLOBs, so store plain floats
+        rows = [(self.key(*triple), float(perplexity), now)
+                for triple, perplexity in zip(
+                    zip(sequences, start_indices, end_indices),
+                    perplexities)]
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO perplexities VALUES (?, ?, ?)', rows)
+        self.evict()
+
+    def size(self):
+        '''Bytes used by the live pages of the database.'''
+        page_count, = self.conn.execute('PRAGMA page_count').fetchone()
+        free_pages, = self.conn.execute('PRAGMA freelist_count').fetchone()
+        page_size, = self.conn.execute('PRAGMA page_size').fetchone()
+        return (page_count - free_pages) * page_size
+
+    def evict(self):
+        '''
+        Remove the least recently used entries if the database is over its
+        size limit. Freed pages are reused, so the file stops growing.
+        '''
+        if self.size() <= self.max_bytes:
+            return
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            count, = self.conn.execute(
+                'SELECT COUNT(*) FROM perplexities').fetchone()
+            self.conn.execute(
+                'DELETE FROM perplexities WHERE key IN ('
+                'SELECT key FROM perplexities ORDER BY last_used LIMIT ?)',
+                (max(1, int(count * EVICT_RATIO)),))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        self.conn.close()
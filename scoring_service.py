@@ -0,0 +1,280 @@
+'''
+Long-lived perplexity scoring service for evaluate_diffs.
+
+Loading TensorFlow and the BiLSTM character language model takes much
+longer than scoring a small diff file. This service loads the model once
+and answers requests over a Unix socket (or stdin/stdout):
+
+    python scoring_service.py --socket /tmp/clm.sock [--clm_path DIR]
+    python evaluate_diffs.py diffs/ --server /tmp/clm.sock
+
+The protocol is JSON Lines. A request is either
+    {"op": "predict", "sequences": [...], "start_indices": [...],
+     "end_indices": [...], "batch_size": 12000}
+answered by {"perplexities": [...]}, or {"op": "model_id"}, answered by
+{"model_id": "..."}. Errors are answered by {"error": "..."}.
+
+--stub serves a deterministic stand-in model, for machines without the
+real language model.
+'''
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import zlib
+from sys import path, stdin, stdout
+
+import instrument
+from perplexity_cache import file_hash
+
+CLM_PATH = '/storage/sata2tbssd/character_language_models/'
+MODEL_NAME = 'bilstm_model_512.h5'
+# characters (sequence length x batch size, padding included) per
+# predict_subsequences call of TokenBudgetModel
+MAX_TOKENS = 1_000_000
+
+
+def model_fname(clm_path):
+    return os.path.join(clm_path, MODEL_NAME)
+
+
+def load_model(clm_path=CLM_PATH):
+    '''Load the BiLSTM character language model from clm_path.'''
+    path.append(clm_path)
+    import lstm_model
+    from encode_characters import InputEncoder, OutputEncoder
+
+    input_enc = InputEncoder(file=os.path.join(clm_path,
+                                               'input_encoder.json'))
+    output_enc = OutputEncoder(file=os.path.join(clm_path,
+                                                 'output_encoder.json'))
+    return lstm_model.BiLSTM_Model.load(model_fname(clm_path),
+                                        input_enc, output_enc)
+
+
+class StubModel:
+    '''
+    Stand-in for the language model with the same predict_subsequences
+    interface. Perplexities are a deterministic function of the text.
+    '''
+    model_id = 'stub'
+
+    def predict_subsequences(self, sequences, start_indices=None,
+                             end_indices=None, token_dicts=False,
+                             batch_size=None):
+        return [{'substr-perpl':
+                 1 + zlib.crc32(sequence.encode('utf-8')) % 100000 / 1000}
+                for sequence in sequences]
+
+
+class TokenBudgetModel:
+    '''
+    Batching layer in front of a model. Sequences are sorted by length and
+    cut into batches of at most max_tokens characters, padding included,
+    so short sequences are not padded to the longest one and batches of
+    long ones stay within memory. Predictions are returned in the order of
+    the input.
+    '''
+
+    def __init__(self, model, max_tokens=MAX_TOKENS):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.seconds = 0.0
+
+    @property
+    def model_id(self):
+        return self.model.model_id
+
+    def batches(self, lengths):
+        '''Lists of sequence indices, longest sequences first.'''
+        order = sorted(range(len(lengths)), key=lambda ix: -lengths[ix])
+        batch = []
+        for ix in order:
+            # the first sequence of a batch is the longest
+            if batch and (len(batch) + 1) * lengths[batch[0]] \
+                    > self.max_tokens:
+                yield batch
+                batch = []
+            batch.append(ix)
+        if batch:
+            yield batch
+
+    def predict_subsequences(self, sequences, start_indices=None,
+                             end_indices=None, token_dicts=False,
+                             batch_size=None):
+        lengths = [len(sequence) for sequence in sequences]
+        preds = [None] * len(sequences)
+        start_t = time.perf_counter()
+        for batch in self.batches(lengths):
+            batch_preds = self.model.predict_subsequences(
+                [sequences[ix] for ix in batch],
+                start_indices=None if start_indices is None
+                else [start_indices[ix] for ix in batch],
+                end_indices=None if end_indices is None
+                else [end_indices[ix] for ix in batch],
+                token_dicts=token_dicts, batch_size=len(batch))
+            for ix, pred in zip(batch, batch_preds):
+                preds[ix] = pred
+            tokens = sum(lengths[ix] for ix in batch)
+            self.tokens += tokens
+            self.padded_tokens += len(batch) * lengths[batch[0]]
+            instrument.count('model_calls')
+            instrument.count('model_tokens', tokens)
+            instrument.count('model_padded_tokens',
+                             len(batch) * lengths[batch[0]])
+        self.seconds += time.perf_counter() - start_t
+        return preds
+
+    def stats(self):
+        return {'tokens': self.tokens,
+                'tokens_per_s': round(self.tokens / self.seconds)
+                if self.seconds else 0,
+                'padding_ratio': round(1 - self.tokens / self.padded_tokens, 4)
+                if self.padded_tokens else 0.0}
+
+
+class ScoringClient:
+    '''
+    Client of a running scoring service, usable in place of the model.
+    '''
+
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.reader = self.sock.makefile('r', encoding='utf-8')
+        self.writer = self.sock.makefile('w', encoding='utf-8')
+
+    def request(self, message):
+        self.writer.write(json.dumps(message) + '\n')
+        self.writer.flush()
+        response = json.loads(self.reader.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    @property
+    def model_id(self):
+        return self.request({'op': 'model_id'})['model_id']
+
+    def predict_subsequences(self, sequences, start_indices=None,
+                             end_indices=None, token_dicts=False,
+                             batch_size=12000):
+        response = self.request({'op': 'predict',
+                                 'sequences': list(sequences),
+                                 'start_indices': start_indices,
+                                 'end_indices': end_indices,
+                                 'batch_size': batch_size})
+        return [{'substr-perpl': perpl}
+                for perpl in response['perplexities']]
+
+    def close(self):
+        self.sock.close()
+
+
+class Scorer:
+    '''Answers protocol requests with one loaded model.'''
+
+    def __init__(self, model, model_id):
+        self.model = model
+        self.model_id = model_id
+        # the model is shared by all connections
+        self.lock = threading.Lock()
+
+    def handle(self, message):
+        try:
+            if message.get('op') == 'model_id':
+                return {'model_id': self.model_id}
+            if message.get('op') != 'predict':
+                return {'error': f"unknown op {message.get('op')!r}"}
+            with self.lock:
+                preds = self.model.predict_subsequences(
+                    message['sequences'],
+                    start_indices=message.get('start_indices'),
+                    end_indices=message.get('end_indices'),
+                    token_dicts=False,
+                    batch_size=message.get('batch_size', 12000))
+            return {'perplexities': [float(pred['substr-perpl'])
+                                     for pred in preds]}
+        except Exception as e:
+            return {'error': repr(e)}
+
+    def serve_lines(self, infile, outfile):
+        for line in infile:
+            if not line.strip():
+                continue
+            try:
+                message = json.loads(line)
+            except ValueError as e:
+                response = {'error': f'malformed request: {e}'}
+            else:
+                response = self.handle(message)
+            outfile.write(json.dumps(response) + '\n')
+            outfile.flush()
+
+
+class LineWriter:
+    '''Text interface over a binary socket file.'''
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        self.wfile.write(text.encode('utf-8'))
+
+    def flush(self):
+        self.wfile.flush()
+
+
+def serve_socket(scorer, socket_path):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            scorer.serve_lines((line.decode('utf-8') for line in self.rfile),
+                               LineWriter(self.wfile))
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path,
+                                                Handler) as server:
+        print(f'Serving {scorer.model_id} on {socket_path}', flush=True)
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', type=str, default=None,
+                        help='Unix socket to listen on (default: serve '
+                             'requests from stdin to stdout)')
+    parser.add_argument('--clm_path', type=str, default=CLM_PATH,
+                        help='Directory of the character language model')
+    parser.add_argument('--stub', action='store_true',
+                        help='Serve a deterministic stub model')
+    parser.add_argument('--max_tokens', type=int, default=MAX_TOKENS,
+                        help='Characters per model call, padding included')
+    return parser.parse_args()
+
+
+def main():
+    args = argparser()
+    if args.stub:
+        scorer = Scorer(TokenBudgetModel(StubModel(), args.max_tokens),
+                        StubModel.model_id)
+    else:
+        scorer = Scorer(TokenBudgetModel(load_model(args.clm_path),
+                                         args.max_tokens),
+                        file_hash(model_fname(args.clm_path)))
+    if args.socket is None:
+        scorer.serve_lines(stdin, stdout)
+    else:
+        serve_socket(scorer, args.socket)
+
+
+if __name__ == '__main__':
+    main()